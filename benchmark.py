@@ -0,0 +1,300 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+from discriminator import Discriminator
+from generator import Generator, GraphAttention, AdaptiveInstanceNorm
+from sphere import load_sphere, sphere_knn
+from main import make_train_batch, batch_sz, latent_dim, learning_rate_d, learning_rate_g, num_points, per_point_loss_weight
+
+# ====== BENCHMARK / PROFILING HARNESS ===========
+# Times each component for every (batch size, point count, k) case:
+#   trace time (first call, incl. building variables), latency percentiles, clouds/sec and peak memory
+#   python benchmark.py --components generator train_batch --batch_sizes 1 16 --num_points 1024 2048 --out bench.json
+#   python benchmark.py --compare bench.json   # exit code 1 if any median latency regressed by more than --tolerance
+#   python benchmark.py --profile_dir logdir --profile_component generator   # TF Profiler trace of a few steps
+#   python benchmark.py --check   # rewritten paths (factored edge conv, fused D, tiled kNN) vs the exact ones, at every --k
+#                                 # and k=16, exit code 1 if they differ
+# GraphAttention pieces run on the second layer's input ([B, N, 64], dynamic kNN), the only one that rebuilds its graph.
+# The models keep their own k (20), k only changes the GraphAttention pieces.
+# graph_attention runs the factored edge conv, graph_attention_concat (and edge_feature/edge_mlps) the explicit edge features.
+# train_batch_fused / train_batch_fused_reuse are the make_train_batch switches (train_batch is the exact step).
+components = ["pairwise_distance", "top_k", "knn_tiled", "edge_feature", "edge_mlps", "graph_attention", "graph_attention_concat",
+              "adain", "generator", "discriminator", "train_batch", "train_batch_fused", "train_batch_fused_reuse"]
+graph_attention_components = components[:7]
+train_variants = {
+    "train_batch": dict(fuse_discriminator=False, reuse_generator_forward=False),
+    "train_batch_fused": dict(fuse_discriminator=True, reuse_generator_forward=False),
+    "train_batch_fused_reuse": dict(fuse_discriminator=True, reuse_generator_forward=True),
+}
+feature_dim = 64 # GraphAttention 2 input channels
+
+
+def make_case(component, B, N, k):
+    """returns: (function, its input tensors)"""
+    features = tf.random.normal([B, N, feature_dim])
+    if component in graph_attention_components:
+        layer = GraphAttention(feature_dim, 2*feature_dim, k, N, factored_edge_conv=component != "graph_attention_concat")
+        nn_idx = GraphAttention.knn(GraphAttention.pairwise_distance(features), k)
+        if component == "pairwise_distance":
+            return GraphAttention.pairwise_distance, [features]
+        if component == "top_k":
+            return lambda adj: GraphAttention.knn(adj, k), [GraphAttention.pairwise_distance(features)]
+        if component == "knn_tiled":
+            return lambda x: GraphAttention.knn_tiled(x, k), [features]
+        if component == "edge_feature":
+            return lambda x, idx: layer.get_edge_feature(tf.expand_dims(x, axis=2), idx, k), [features, nn_idx]
+        if component == "edge_mlps":
+            def edge_mlps(upper, lower):
+                return layer.conv_out(layer.MLPs_upper(upper) * layer.MLPs_lower(lower))
+            return edge_mlps, list(layer.get_edge_feature(tf.expand_dims(features, axis=2), nn_idx, k))
+        return layer, [features]
+    if component == "adain":
+        return AdaptiveInstanceNorm(), [features, tf.random.normal([B, N, 2*feature_dim])]
+
+    sphere = tf.cast(load_sphere(N), tf.float32)
+    spheres = tf.repeat(tf.expand_dims(sphere, axis=0), B, axis=0)
+    sphere_nn_idx = sphere_knn(N)
+    G = Generator(N, latent_dim, per_point_loss_weight, sphere_nn_idx=sphere_nn_idx)
+    D = Discriminator(N, per_point_loss_weight)
+    real_clouds = tf.random.uniform([B, N, 3], -1, 1)
+    if component == "generator":
+        return G, [spheres, tf.random.normal([B, latent_dim])]
+    if component == "discriminator":
+        return D, [real_clouds]
+    g_optimizer = keras.optimizers.Adam(learning_rate_g, beta_1=0.5)
+    d_optimizer = keras.optimizers.Adam(learning_rate_d, beta_1=0.5)
+    return make_train_batch(G, D, g_optimizer, d_optimizer, sphere, B, latent_dim, **train_variants[component]), [real_clouds]
+
+
+def fused_score_diff(N, B=2):
+    """max abs difference between the scores of one [real; fake] D pass and two separate passes"""
+    D = Discriminator(N, per_point_loss_weight)
+    real_clouds, fake_clouds = tf.random.uniform([B, N, 3], -1, 1), tf.random.uniform([B, N, 3], -1, 1)
+    shape_score, per_point_score = D(tf.concat([real_clouds, fake_clouds], axis=0))
+    separate = [D(real_clouds), D(fake_clouds)]
+    shape_diff = tf.abs(shape_score - tf.concat([separate[0][0], separate[1][0]], axis=0))
+    per_point_diff = tf.abs(per_point_score - tf.concat([separate[0][1], separate[1][1]], axis=0))
+    return float(tf.maximum(tf.reduce_max(shape_diff), tf.reduce_max(per_point_diff)))
+
+
+def edge_conv_diff(N, k, B=2):
+    """
+    max differences (relative to the largest value) between the factored and the explicit edge conv with the same
+    weights, for a dynamic kNN graph and a static one shared by the batch
+    returns: {"dynamic": (output diff, diff of the gradients w.r.t. the input and the weights), "static": (...)}
+    Rounding differs, so a pre-activation right at a LeakyReLU kink can land on the other side: the gradients
+    agree less tightly than the outputs.
+    """
+    x = tf.random.normal([B, N, feature_dim])
+    layer = GraphAttention(feature_dim, 2*feature_dim, k, N)
+    static_idx = GraphAttention.knn(GraphAttention.pairwise_distance(x[:1]), k)[0]
+    diffs_by_path = {}
+    for path, nn_idx in [("dynamic", None), ("static", static_idx)]:
+        results = []
+        for factored in [True, False]:
+            layer.factored_edge_conv = factored
+            with tf.GradientTape() as tape:
+                tape.watch(x)
+                out = layer(x, nn_idx=nn_idx)
+                loss = tf.reduce_sum(out * tf.sin(out)) # non-trivial upstream gradient
+            results.append([out] + tape.gradient(loss, [x] + layer.trainable_variables))
+        diffs = [float(tf.reduce_max(tf.abs(a - b)) / (tf.reduce_max(tf.abs(b)) + 1e-12)) for a, b in zip(*results)]
+        diffs_by_path[path] = (diffs[0], max(diffs[1:]))
+    layer.factored_edge_conv = True
+    return diffs_by_path
+
+
+def knn_tiled_mismatches(N, k, B=2):
+    """neighbor indices that differ between knn_tiled (several row blocks) and the dense knn"""
+    x = tf.random.normal([B, N, feature_dim])
+    dense = GraphAttention.knn(GraphAttention.pairwise_distance(x), k)
+    tiled = GraphAttention.knn_tiled(x, k, memory_budget=B * N * 4 * max(N // 4, 1)) # ~4 blocks
+    return int(tf.reduce_sum(tf.cast(dense != tiled, tf.int32)))
+
+
+def check_equivalence(N, k_values, checks, output_tolerance=1e-5, gradient_tolerance=1e-2, seed=0):
+    """
+    checks: "fused_score", "edge_conv" and/or "knn_tiled", the rewritten paths must match the exact ones on the same
+    weights, the GraphAttention ones for every k in k_values
+    returns: True if every difference is within tolerance
+    """
+    tf.random.set_seed(seed)
+    passed = True
+    if "fused_score" in checks:
+        diff = fused_score_diff(N)
+        passed &= diff <= output_tolerance
+        print("fused D score          max abs diff %g (tolerance %g)%s" % (diff, output_tolerance, "" if diff <= output_tolerance else "  FAILED"))
+    for k in k_values:
+        if "knn_tiled" in checks:
+            mismatches = knn_tiled_mismatches(N, k)
+            passed &= mismatches == 0
+            print("knn_tiled k=%-3d        %d neighbor indices differ from the dense kNN%s" % (k, mismatches, "" if mismatches == 0 else "  FAILED"))
+        if "edge_conv" in checks:
+            for path, (out_diff, grad_diff) in edge_conv_diff(N, k).items():
+                ok = out_diff <= output_tolerance and grad_diff <= gradient_tolerance
+                passed &= ok
+                print("factored edge conv %-7s k=%-3d max relative diff: outputs %g (tolerance %g), gradients %g (tolerance %g)%s" % (
+                    path, k, out_diff, output_tolerance, grad_diff, gradient_tolerance, "" if ok else "  FAILED"))
+    return passed
+
+
+class PeakMemory:
+    """
+    peak memory allocated while the block runs, above what was allocated before it: from TensorFlow's allocator
+    stats for the device (GPU:0, else CPU:0), or from sampling the resident set size if those aren't tracked
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.device = "GPU:0" if tf.config.list_logical_devices("GPU") else "CPU:0"
+
+    def rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        try:
+            self.start = tf.config.experimental.get_memory_info(self.device)["current"]
+            tf.config.experimental.reset_memory_stats(self.device)
+            self.source = self.device
+            return self
+        except (ValueError, tf.errors.OpError):
+            self.source = "rss"
+        self.start = self.peak = self.rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.source != "rss":
+            self.bytes = tf.config.experimental.get_memory_info(self.device)["peak"] - self.start
+            return
+        self.done.set()
+        self.thread.join()
+        self.bytes = max(self.peak, self.rss()) - self.start
+
+
+def sync(outputs):
+    """waits for every output tensor"""
+    return tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, "numpy") else t, outputs)
+
+
+def run_case(component, B, N, k, steps, warmup, profile_dir=None, profile_steps=5):
+    with PeakMemory() as memory:
+        fn, inputs = make_case(component, B, N, k)
+        fn = fn if isinstance(fn, tf.types.experimental.GenericFunction) else tf.function(fn)
+        start = time.perf_counter()
+        sync(fn(*inputs))
+        trace_seconds = time.perf_counter() - start
+        for _ in range(warmup):
+            sync(fn(*inputs))
+        latencies = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            sync(fn(*inputs))
+            latencies.append(time.perf_counter() - start)
+        if profile_dir:
+            tf.profiler.experimental.start(profile_dir)
+            for step in range(profile_steps):
+                with tf.profiler.experimental.Trace(component, step_num=step, _r=1):
+                    sync(fn(*inputs))
+            tf.profiler.experimental.stop()
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        "component": component, "batch_sz": B, "num_points": N, "k": k,
+        "trace_seconds": trace_seconds,
+        "mean_ms": float(np.mean(latencies_ms)),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p90_ms": float(np.percentile(latencies_ms, 90)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "clouds_per_sec": B / float(np.mean(latencies)),
+        "peak_memory_bytes": int(memory.bytes), "memory_source": memory.source,
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    """prints the median latency change of every case also in the baseline, returns the regressed ones"""
+    with open(baseline_path) as f:
+        baseline = {(r["component"], r["batch_sz"], r["num_points"], r["k"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        old = baseline.get((result["component"], result["batch_sz"], result["num_points"], result["k"]))
+        if old is None:
+            continue
+        ratio = result["p50_ms"] / old["p50_ms"]
+        regressed = ratio > 1 + tolerance
+        print("%-24s B=%-3d N=%-5d k=%-3d p50 %8.2fms -> %8.2fms  %.2fx%s" % (result["component"], result["batch_sz"],
+            result["num_points"], result["k"], old["p50_ms"], result["p50_ms"], ratio, "  REGRESSED" if regressed else ""))
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the model components and the training step")
+    parser.add_argument("--components", nargs="+", default=components, choices=components)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[batch_sz])
+    parser.add_argument("--num_points", type=int, nargs="+", default=[1024, num_points])
+    parser.add_argument("--k", type=int, nargs="+", default=[20])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--out", default=None, help="write the results as JSON")
+    parser.add_argument("--compare", default=None, help="earlier --out JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed median latency increase for --compare")
+    parser.add_argument("--profile_dir", default=None, help="capture a TF Profiler trace (view in TensorBoard)")
+    parser.add_argument("--profile_component", default="train_batch", choices=components)
+    parser.add_argument("--profile_steps", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="only run the equivalence checks, exit code 1 if one fails")
+    parser.add_argument("--output_tolerance", type=float, default=1e-5, help="equivalence checks: outputs")
+    parser.add_argument("--gradient_tolerance", type=float, default=1e-2, help="equivalence checks: gradients")
+    args = parser.parse_args()
+
+    # the rewritten paths of the selected components are checked against the exact ones first
+    checks = ["fused_score", "edge_conv", "knn_tiled"] if args.check else []
+    if any(name.startswith("train_batch_fused") for name in args.components):
+        checks.append("fused_score")
+    if any(name.startswith("graph_attention") for name in args.components):
+        checks.append("edge_conv")
+    if "knn_tiled" in args.components:
+        checks.append("knn_tiled")
+    # every benchmarked k, plus one other than the models' 20 so a k threaded wrongly through the layer shows up
+    k_values = sorted(set(args.k) | {16})
+    equivalent = check_equivalence(min(args.num_points), k_values, set(checks), args.output_tolerance, args.gradient_tolerance)
+    if args.check:
+        sys.exit(0 if equivalent else 1)
+
+    results = []
+    for component in args.components:
+        k_values = args.k if component in graph_attention_components else [20]
+        for B in args.batch_sizes:
+            for N in args.num_points:
+                for k in k_values:
+                    profile_dir = args.profile_dir if component == args.profile_component else None
+                    result = run_case(component, B, N, k, args.steps, args.warmup, profile_dir, args.profile_steps)
+                    results.append(result)
+                    print("%-24s B=%-3d N=%-5d k=%-3d trace %6.2fs  p50 %9.2fms  p90 %9.2fms  p99 %9.2fms  %8.1f clouds/sec  peak %7.1fMB (%s)" % (
+                        component, B, N, k, result["trace_seconds"], result["p50_ms"], result["p90_ms"], result["p99_ms"],
+                        result["clouds_per_sec"], result["peak_memory_bytes"] / 2**20, result["memory_source"]))
+
+    if args.out:
+        env = {"tensorflow": tf.__version__, "python": platform.python_version(), "machine": platform.machine(),
+               "devices": [d.name for d in tf.config.list_logical_devices()], "time": time.time()}
+        with open(args.out, "w") as f:
+            json.dump({"env": env, "results": results}, f, indent=2)
+    regressed = args.compare and compare(results, args.compare, args.tolerance)
+    sys.exit(1 if regressed or not equivalent else 0)
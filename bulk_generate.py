@@ -0,0 +1,148 @@
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+
+# ====== BULK GENERATION ===========
+# Generates num_clouds Bluenos into <out_dir>/shard_<j>.npy files of shard_size clouds [S, N, 3] (float16 or float32,
+# np.load(..., mmap_mode="r") works on them) while a writer thread fills the shards: the generator only waits on disk
+# when the bounded queue is full. Cloud i is generated from latent_i ~ N(0,1) drawn from (seed, i) alone.
+# <out_dir>/manifest.json             run settings (seed, counts, dtype, checkpoint)
+# <out_dir>/shard_<j>_latents.npy     the latent vector of every cloud of shard j
+# <out_dir>/shard_<j>.json            written last, marks shard j complete (first cloud index, count)
+# Interrupted runs resume by skipping complete shards. --shard i/n makes this process do every n-th shard, so n
+# processes (or hosts sharing out_dir) split the run.
+#   python bulk_generate.py --num_clouds 200000 --out_dir bluenos --dtype float16 --shard 0/2
+
+
+def latents(seed, first, count, latent_dim):
+    """returns: latent vectors of clouds first..first+count-1 [count, latent_dim] (float32)"""
+    return np.stack([np.random.default_rng([seed, i]).standard_normal(latent_dim, dtype=np.float32)
+                     for i in range(first, first + count)])
+
+
+def shard_path(out_dir, j):
+    return os.path.join(out_dir, "shard_%05d" % j)
+
+
+def complete_shards(out_dir):
+    """returns: [(clouds memmap [S, N, 3], latents [S, latent_dim], shard json)] of every complete shard, in order"""
+    shards = []
+    for info_path in sorted(glob.glob(os.path.join(out_dir, "shard_*.json"))):
+        prefix = os.path.splitext(info_path)[0]
+        with open(info_path) as f:
+            info = json.load(f)
+        shards.append((np.load(prefix + ".npy", mmap_mode="r"), np.load(prefix + "_latents.npy"), info))
+    return shards
+
+
+def write_shards(jobs, out_dir, dtype, errors):
+    """
+    writer thread: jobs are (shard j, first cloud index, shard count, offset in shard, clouds [b, N, 3], latents [b, D])
+    of consecutive batches; a shard is renamed into place once all its clouds arrived
+    """
+    try:
+        clouds = None
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            j, first, count, offset, batch, batch_latents = job
+            prefix = shard_path(out_dir, j)
+            if offset == 0:
+                clouds = np.lib.format.open_memmap(prefix + ".tmp.npy", mode="w+", dtype=dtype, shape=(count,) + batch.shape[1:])
+                shard_latents = np.empty([count, batch_latents.shape[1]], np.float32)
+            clouds[offset:offset+len(batch)] = batch
+            shard_latents[offset:offset+len(batch)] = batch_latents
+            if offset + len(batch) == count:
+                clouds.flush()
+                clouds = None
+                os.replace(prefix + ".tmp.npy", prefix + ".npy")
+                np.save(prefix + "_latents.npy", shard_latents)
+                with open(prefix + ".json", "w") as f:
+                    json.dump({"shard": j, "first": first, "count": count}, f)
+    except Exception as error:
+        errors.append(error)
+        while jobs.get() is not None: # keep draining so the generator never blocks on a dead writer
+            pass
+
+
+def bulk_generate(G, sphere, out_dir, num_clouds, seed=0, shard_size=4096, dtype="float32", batch_sz=16,
+                  shard_index=0, num_shards=1, queue_size=8, settings=None):
+    """
+    writes this process's missing shards (every num_shards-th, starting at shard_index)
+    settings: extra manifest entries (e.g. the checkpoint), must agree with earlier runs into out_dir
+    returns: number of clouds generated
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = dict(settings or {}, seed=seed, num_clouds=num_clouds, shard_size=shard_size, dtype=dtype,
+                    num_points=int(sphere.shape[0]), latent_dim=G.latent_dim)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError("%s was written with different settings: %s" % (out_dir, previous))
+    else:
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    total_shards = -(-num_clouds // shard_size)
+    todo = [j for j in range(shard_index, total_shards, num_shards) if not os.path.exists(shard_path(out_dir, j) + ".json")]
+    print("generating %d shards (%d clouds each) into %s" % (len(todo), shard_size, out_dir))
+
+    jobs = queue.Queue(maxsize=queue_size) # bounds the clouds waiting for the disk
+    errors = []
+    writer = threading.Thread(target=write_shards, args=(jobs, out_dir, np.dtype(dtype), errors), daemon=True)
+    writer.start()
+    sphere = tf.cast(sphere, tf.float32)
+    start = time.perf_counter()
+    generated = 0
+    try:
+        for j in todo:
+            first = j * shard_size
+            count = min(shard_size, num_clouds - first)
+            for offset in range(0, count, batch_sz):
+                batch_latents = latents(seed, first + offset, min(batch_sz, count - offset), G.latent_dim)
+                clouds = G.infer(sphere, batch_latents).numpy()
+                if errors:
+                    raise errors[0]
+                jobs.put((j, first, count, offset, clouds, batch_latents))
+                generated += len(clouds)
+            print("shard %d queued  %.1f clouds/sec" % (j, generated / (time.perf_counter() - start)))
+    finally:
+        jobs.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return generated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generate Bluenos in bulk into sharded .npy files")
+    parser.add_argument("--num_clouds", type=int, required=True)
+    parser.add_argument("--out_dir", default="generated_bluenos")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard_size", type=int, default=4096, help="clouds per .npy file")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--batch_sz", type=int, default=16, help="clouds per forward pass")
+    parser.add_argument("--queue_size", type=int, default=8, help="batches buffered between generator and writer")
+    parser.add_argument("--shard", default="0/1", help="i/n: this process writes shards i, i+n, i+2n, ...")
+    parser.add_argument("--checkpoint_path", default=None, help="default inference.checkpoint_path")
+    args = parser.parse_args()
+
+    from inference import load_generator, checkpoint_path
+    shard_index, num_shards = map(int, args.shard.split("/"))
+    G, sphere = load_generator(args.checkpoint_path or checkpoint_path)
+    start = time.perf_counter()
+    generated = bulk_generate(G, sphere, args.out_dir, args.num_clouds, args.seed, args.shard_size, args.dtype,
+                              args.batch_sz, shard_index, num_shards, args.queue_size,
+                              settings={"checkpoint": tf.train.latest_checkpoint(args.checkpoint_path or checkpoint_path)})
+    seconds = time.perf_counter() - start
+    print("%d clouds in %.1fs  %.1f clouds/sec" % (generated, seconds, generated / max(seconds, 1e-9)))
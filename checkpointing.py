@@ -0,0 +1,73 @@
+import json
+import os
+import tensorflow as tf
+
+# ====== RESUMABLE TRAINING CHECKPOINTS ===========
+# Saves everything a run needs to continue exactly where it stopped: G, D, both optimizers, the noise RNG and the
+# position in the data (epoch + batches done in it; epochs are rebuilt deterministically and the done batches skipped).
+# <dir>/ckpt-<step>  the last `keep_last` checkpoints
+# <dir>/best/        the checkpoint with the lowest `best_metric` so far (+ best.json)
+
+
+def checkpoint_options(async_save):
+    """writes in a background thread when this TensorFlow supports it"""
+    if async_save:
+        try:
+            return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        except TypeError:
+            pass
+    return tf.train.CheckpointOptions()
+
+
+class TrainingCheckpoint:
+    def __init__(self, directory, keep_last=3, best_metric="g_loss", async_save=True, **objects):
+        """objects: everything to save, e.g. G=G, D=D, g_optimizer=g_optimizer, d_optimizer=d_optimizer, rng=rng"""
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.batch = tf.Variable(0, dtype=tf.int64, trainable=False) # batches done in self.epoch
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(epoch=self.epoch, batch=self.batch, step=self.step, **objects)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=keep_last)
+        self.best_manager = tf.train.CheckpointManager(self.checkpoint, os.path.join(directory, "best"), max_to_keep=1)
+        self.best_path = os.path.join(directory, "best", "best.json")
+        self.best_metric = best_metric
+        self.best_value = None
+        if os.path.exists(self.best_path):
+            with open(self.best_path) as f:
+                self.best_value = json.load(f).get(best_metric) # None: best_metric changed, start a new best record
+            if self.best_value is None:
+                print("%s has no %s, the next evaluation becomes the best" % (self.best_path, best_metric))
+        self.options = checkpoint_options(async_save)
+
+    def restore(self):
+        """loads the latest checkpoint if there is one, returns (epoch, batches done in it, global step)"""
+        if self.manager.latest_checkpoint:
+            print("resuming from " + self.manager.latest_checkpoint)
+            # models/optimizer slots built later (first train step) get their values restored when they are created
+            self.checkpoint.restore(self.manager.latest_checkpoint).assert_existing_objects_matched()
+        return int(self.epoch.numpy()), int(self.batch.numpy()), int(self.step.numpy())
+
+    def save(self, epoch, batch, step):
+        """queues a checkpoint of the current state, returns its path"""
+        self.epoch.assign(epoch)
+        self.batch.assign(batch)
+        self.step.assign(step)
+        return self.manager.save(checkpoint_number=step, options=self.options)
+
+    def save_if_best(self, epoch, batch, step, value):
+        """also keeps the current state under best/ if value (of best_metric, lower is better) is the lowest yet"""
+        if self.best_value is not None and value >= self.best_value:
+            return None
+        self.best_value = value
+        self.epoch.assign(epoch)
+        self.batch.assign(batch)
+        self.step.assign(step)
+        path = self.best_manager.save(checkpoint_number=step, options=self.options)
+        os.makedirs(os.path.dirname(self.best_path), exist_ok=True) # async saves may not have created it yet
+        with open(self.best_path, "w") as f:
+            json.dump({self.best_metric: value, "step": step, "path": path}, f)
+        return path
+
+    def sync(self):
+        """waits for queued background writes"""
+        if hasattr(self.checkpoint, "sync"):
+            self.checkpoint.sync()
@@ -37,7 +37,7 @@ class Discriminator(keras.Model):
             LeakyReLU(self.leaky_grad),
             Dense(64),
             LeakyReLU(self.leaky_grad),
-            Dense(1, 'sigmoid') 
+            Dense(1, 'sigmoid', dtype='float32') # float32 scores under mixed precision
         ])
         self.MLPs_per_point = Sequential([
             Dense(512),
@@ -46,7 +46,7 @@ class Discriminator(keras.Model):
             LeakyReLU(self.leaky_grad),
             Dense(64),
             LeakyReLU(self.leaky_grad),
-            Dense(1, 'sigmoid') 
+            Dense(1, 'sigmoid', dtype='float32') # float32 scores under mixed precision
         ])
 
         
@@ -65,11 +65,11 @@ class Discriminator(keras.Model):
         # 1) per-shape score
         pooled = self.max_pool(features)
         per_shape_score = self.MLPs_per_shape(pooled) 
-        per_shape_score = tf.squeeze(per_shape_score) # [B,1]
+        per_shape_score = tf.squeeze(per_shape_score, axis=-1) # [B]
 
         # per-point score
         per_point_score = self.MLPs_per_point(features) 
-        per_point_score = tf.squeeze(per_point_score) # [B,N]
+        per_point_score = tf.squeeze(per_point_score, axis=-1) # [B,N]
 
         return [per_shape_score, per_point_score]
 
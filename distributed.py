@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import tensorflow as tf
+
+# ====== DATA-PARALLEL TRAINING ===========
+# main.py trains under the strategy picked by its `distribution` global:
+#   None           single device (the default strategy)
+#   "mirrored"     one replica per local device, CPUs are split into `num_cpu_replicas` logical devices
+#   "multi_worker" MultiWorkerMirroredStrategy, one process per host described by the TF_CONFIG env var
+# Every replica trains on batch_sz clouds (AdaIN keeps one gamma/beta per batch slot), so the global batch is
+# batch_sz * replicas. No BatchNorm needs cross-replica statistics: D's and GraphAttention's run in inference
+# mode (moving statistics), AdaIN's normalize each point of each cloud on its own.
+#
+# Local scaling report, N worker processes on this machine for every N:  python distributed.py --workers 1 2 4
+
+
+def make_strategy(distribution=None, num_cpu_replicas=1):
+    """must run before TensorFlow initializes its devices"""
+    if distribution is None:
+        return tf.distribute.get_strategy()
+    if distribution == "mirrored":
+        if tf.config.list_physical_devices("GPU") and num_cpu_replicas == 1:
+            return tf.distribute.MirroredStrategy() # every local GPU
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * num_cpu_replicas)
+        return tf.distribute.MirroredStrategy(["/cpu:%d" % i for i in range(num_cpu_replicas)])
+    if distribution == "multi_worker":
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError("unknown distribution " + distribution)
+
+
+def task_dir(path, strategy):
+    """path for the chief (or a single process), path/worker_<i> for the other workers so their files don't collide"""
+    resolver = strategy.cluster_resolver
+    if resolver is None or resolver.task_id == 0:
+        return path
+    return os.path.join(path, "worker_%d" % resolver.task_id)
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch(num_workers, args):
+    """runs `python distributed.py worker <args>` as num_workers processes of one local cluster, returns their outputs"""
+    cluster = {"worker": ["localhost:%d" % port for port in free_ports(num_workers)]}
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}}))
+        processes.append(subprocess.Popen([sys.executable, __file__, "worker"] + args, env=env, stdout=subprocess.PIPE))
+    outputs = [p.communicate()[0].decode() for p in processes]
+    if any(p.returncode for p in processes):
+        raise RuntimeError("a worker failed with %d workers" % num_workers)
+    return outputs
+
+
+def worker(steps, batch_sz, num_points, threads):
+    """times `steps` distributed train steps on random clouds, the chief prints a JSON line"""
+    from discriminator import Discriminator
+    from generator import Generator
+    from sphere import load_sphere, sphere_knn
+    from main import make_train_batch, latent_dim, learning_rate_d, learning_rate_g, per_point_loss_weight
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    strategy = make_strategy("multi_worker")
+    sphere = load_sphere(num_points)
+    with strategy.scope():
+        G = Generator(num_points, latent_dim, per_point_loss_weight, sphere_nn_idx=sphere_knn(num_points))
+        D = Discriminator(num_points, per_point_loss_weight)
+        g_optimizer = tf.keras.optimizers.Adam(learning_rate_g, beta_1=0.5)
+        d_optimizer = tf.keras.optimizers.Adam(learning_rate_d, beta_1=0.5)
+    train_batch = make_train_batch(G, D, g_optimizer, d_optimizer, sphere, batch_sz, latent_dim, strategy=strategy)
+
+    global_batch_sz = batch_sz * strategy.num_replicas_in_sync
+    dataset = tf.data.Dataset.from_tensors(tf.random.uniform([batch_sz, num_points, 3], -1, 1)).repeat()
+    real_clouds = iter(strategy.experimental_distribute_dataset(dataset.unbatch().batch(global_batch_sz)))
+
+    train_batch(next(real_clouds))[0].numpy() # trace
+    start = time.perf_counter()
+    for _ in range(steps):
+        d_loss = train_batch(next(real_clouds))[0]
+    d_loss.numpy()
+    seconds = (time.perf_counter() - start) / steps
+    if strategy.cluster_resolver.task_id == 0:
+        print(json.dumps({"workers": strategy.num_replicas_in_sync, "global_batch": global_batch_sz,
+            "step_seconds": seconds, "examples_per_sec": global_batch_sz / seconds}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local multi-worker scaling report")
+    parser.add_argument("mode", nargs="?", default="report", choices=["report", "worker"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--batch_sz", type=int, default=16, help="per worker")
+    parser.add_argument("--num_points", type=int, default=2048)
+    parser.add_argument("--threads", type=int, default=0, help="TF threads per worker, 0 = cores / workers")
+    args = parser.parse_args()
+
+    if args.mode == "worker":
+        worker(args.steps, args.batch_sz, args.num_points, args.threads)
+    else:
+        results = []
+        for num_workers in args.workers:
+            threads = args.threads or max(os.cpu_count() // num_workers, 1)
+            outputs = launch(num_workers, ["--steps", str(args.steps), "--batch_sz", str(args.batch_sz),
+                "--num_points", str(args.num_points), "--threads", str(threads)])
+            result = json.loads([line for line in outputs[0].splitlines() if line.startswith("{")][-1])
+            results.append(result)
+            print("%2d workers  global batch %4d  step %7.1fms  %7.2f examples/sec  %.2fx" % (
+                num_workers, result["global_batch"], 1000*result["step_seconds"], result["examples_per_sec"],
+                result["examples_per_sec"] / results[0]["examples_per_sec"]))
@@ -0,0 +1,204 @@
+import argparse
+import json
+import numpy as np
+import tensorflow as tf
+
+# ====== GENERATED vs. REAL EVALUATION ===========
+# Standard point cloud GAN metrics (Achlioptas et al. 2018, Yang et al. 2019) under Chamfer (cd) and EMD (emd):
+#   cov   fraction of real clouds that are the nearest real cloud of some generated cloud (higher is better)
+#   mmd   mean distance from every real cloud to its nearest generated cloud (lower is better)
+#   1nna  leave-one-out 1-NN classifier accuracy on generated + real clouds (0.5 is best)
+# Cloud-to-cloud distances run on batches of cloud pairs sized to a memory budget. EMD is approximated with
+# Sinkhorn iterations on a subset of the points. With ann_k, every nearest neighbor search first shortlists ann_k
+# candidates by a cheap occupancy descriptor (faiss if installed, else brute force) and only measures those pairs.
+#   python evaluation.py --num_generated 1000 --ann_k 10 --out eval.json
+
+
+# ====== CLOUD PAIR DISTANCES ==========
+def squared_distances(a, b):
+    """a: [P, N, 3], b: [P, M, 3], returns: [P, N, M]"""
+    inner = tf.matmul(a, b, transpose_b=True)
+    return tf.maximum(tf.reduce_sum(a*a, -1)[:, :, None] - 2*inner + tf.reduce_sum(b*b, -1)[:, None, :], 0)
+
+
+@tf.function(input_signature=[tf.TensorSpec([None, None, 3], tf.float32)] * 2)
+def chamfer(a, b):
+    """a: [P, N, 3], b: [P, M, 3], returns: [P] mean squared distance to the nearest point of the other cloud, both ways"""
+    dist = squared_distances(a, b)
+    return tf.reduce_mean(tf.reduce_min(dist, axis=2), axis=1) + tf.reduce_mean(tf.reduce_min(dist, axis=1), axis=1)
+
+
+@tf.function(reduce_retracing=True)
+def sinkhorn_emd(a, b, epsilon=0.02, iterations=100):
+    """
+    a: [P, n, 3], b: [P, n, 3], returns: [P] entropic approximation of the earth mover's distance
+    (mean distance a point travels under the optimal matching of two equally sized clouds)
+    """
+    cost = tf.sqrt(squared_distances(a, b) + 1e-12) # [P, n, n]
+    # each row shifted by its min so no row of the kernel underflows, the scaling u absorbs the shift
+    kernel = tf.exp(-(cost - tf.reduce_min(cost, axis=2, keepdims=True)) / epsilon)
+    weight = 1 / tf.cast(tf.shape(a)[1], tf.float32) # uniform marginals
+    v = tf.ones(tf.shape(cost)[:2])
+    for _ in tf.range(iterations):
+        u = weight / (tf.linalg.matvec(kernel, v) + 1e-30)
+        v = weight / (tf.linalg.matvec(kernel, u, transpose_a=True) + 1e-30)
+    plan = u[:, :, None] * kernel * v[:, None, :]
+    return tf.reduce_sum(plan * cost, axis=[1, 2])
+
+
+metrics = {"cd": chamfer, "emd": sinkhorn_emd}
+
+
+def pair_distances(X, Y, rows, cols, metric="cd", memory_budget=256*2**20):
+    """
+    X: [M, N, 3], Y: [K, N, 3] (numpy or memory-mapped)
+    rows, cols: [P] pairs to measure
+    returns: [P] metric(X[rows], Y[cols])
+    """
+    distance = metrics[metric]
+    pair_bytes = 4 * X.shape[1] * Y.shape[1] * 4 # a few [N, N] float32 intermediates per pair
+    chunk = max(int(memory_budget // pair_bytes), 1)
+    out = np.empty(len(rows), np.float32)
+    for i in range(0, len(rows), chunk):
+        a = tf.constant(X[rows[i:i+chunk]], tf.float32)
+        b = tf.constant(Y[cols[i:i+chunk]], tf.float32)
+        out[i:i+chunk] = distance(a, b).numpy()
+    return out
+
+
+def distance_matrix(X, Y=None, metric="cd", memory_budget=256*2**20):
+    """returns: [M, K] distances between all clouds of X and Y (X and itself, measuring each pair once, if Y is None)"""
+    if Y is None:
+        rows, cols = np.triu_indices(len(X), 1)
+        matrix = np.zeros([len(X), len(X)], np.float32)
+        matrix[rows, cols] = pair_distances(X, X, rows, cols, metric, memory_budget)
+        return matrix + matrix.T
+    rows, cols = np.divmod(np.arange(len(X) * len(Y)), len(Y))
+    return pair_distances(X, Y, rows, cols, metric, memory_budget).reshape([len(X), len(Y)])
+
+
+# ====== APPROXIMATE NEAREST NEIGHBORS ==========
+def descriptors(clouds, bounds, bins=8):
+    """
+    clouds: [M, N, 3], bounds: ([3] low, [3] high)
+    returns: [M, bins**3] square root occupancy histograms (L2 between them ~ Hellinger distance of the densities)
+    """
+    clouds = np.asarray(clouds, np.float32)
+    low, high = bounds
+    cell = np.clip(((clouds - low) / (high - low + 1e-9) * bins).astype(np.int64), 0, bins - 1) # [M, N, 3]
+    voxel = (cell[..., 0] * bins + cell[..., 1]) * bins + cell[..., 2] + np.arange(len(clouds))[:, None] * bins**3
+    counts = np.bincount(voxel.ravel(), minlength=len(clouds) * bins**3).reshape([len(clouds), bins**3])
+    return np.sqrt(counts / clouds.shape[1]).astype(np.float32)
+
+
+def shortlist(queries, index, k, backend="auto"):
+    """returns: [Q, k] rows of index with the closest descriptors to each query"""
+    k = min(k, len(index))
+    if backend == "auto":
+        try:
+            import faiss
+            backend = "faiss"
+        except ImportError:
+            backend = "exact"
+    if backend == "faiss":
+        import faiss
+        search = faiss.IndexHNSWFlat(index.shape[1], 32)
+        search.add(np.ascontiguousarray(index))
+        return search.search(np.ascontiguousarray(queries), k)[1]
+    if backend == "exact":
+        candidates = np.empty([len(queries), k], np.int64)
+        index_norms = np.sum(index**2, axis=1)
+        for i in range(0, len(queries), 1024):
+            dist = index_norms[None, :] - 2 * queries[i:i+1024] @ index.T # + |query|^2, same for every row
+            candidates[i:i+1024] = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        return candidates
+    raise ValueError("unknown ANN backend " + backend)
+
+
+def nearest(X, Y, X_desc, Y_desc, metric="cd", ann_k=10, exclude_self=False, backend="auto", memory_budget=256*2**20):
+    """
+    nearest Y cloud of every X cloud, measured exactly among the ann_k descriptor candidates
+    exclude_self: X and Y are the same set, a cloud is not its own neighbor
+    returns: distances [M], indices [M]
+    """
+    candidates = shortlist(X_desc, Y_desc, ann_k + int(exclude_self), backend) # [M, k]
+    rows = np.repeat(np.arange(len(X)), candidates.shape[1])
+    dist = pair_distances(X, Y, rows, candidates.ravel(), metric, memory_budget).reshape(candidates.shape)
+    if exclude_self:
+        dist[candidates == np.arange(len(X))[:, None]] = np.inf
+    best = np.argmin(dist, axis=1)
+    return dist[np.arange(len(X)), best], candidates[np.arange(len(X)), best]
+
+
+# ====== METRICS ==========
+def evaluate(generated, reference, metric_names=("cd", "emd"), ann_k=None, ann_backend="auto", emd_points=256,
+             memory_budget=256*2**20, seed=0):
+    """
+    generated: [M, N, 3], reference: [K, N, 3] real clouds
+    ann_k: None measures every pair exactly (M*K + M^2/2 + K^2/2 distances), else ~3*(M+K)*ann_k
+    emd_points: points per cloud (a fixed random subset) used for the EMD
+    returns: {"cov_cd", "mmd_cd", "1nna_cd", "cov_emd", ...} (floats)
+    """
+    M, K = len(generated), len(reference)
+    labels = np.concatenate([np.zeros(M), np.ones(K)])
+    if ann_k is not None:
+        low = np.minimum(np.min(generated, axis=(0, 1)), np.min(reference, axis=(0, 1)))
+        high = np.maximum(np.max(generated, axis=(0, 1)), np.max(reference, axis=(0, 1)))
+        gen_desc, ref_desc = descriptors(generated, (low, high)), descriptors(reference, (low, high))
+        all_desc = np.concatenate([gen_desc, ref_desc])
+
+    results = {}
+    for name in metric_names:
+        gen, ref = generated, reference
+        if name == "emd":
+            rng = np.random.default_rng(seed)
+            gen = np.asarray(generated)[:, rng.permutation(generated.shape[1])[:emd_points]]
+            ref = np.asarray(reference)[:, rng.permutation(reference.shape[1])[:emd_points]]
+
+        if ann_k is None:
+            d_gr = distance_matrix(gen, ref, name, memory_budget) # [M, K]
+            d_all = np.block([[distance_matrix(gen, None, name, memory_budget), d_gr],
+                              [d_gr.T, distance_matrix(ref, None, name, memory_budget)]])
+            np.fill_diagonal(d_all, np.inf)
+            gen_nn = np.argmin(d_gr, axis=1)
+            ref_nn_dist = np.min(d_gr, axis=0)
+            all_nn = np.argmin(d_all, axis=1)
+        else:
+            union = np.concatenate([gen, ref])
+            gen_nn = nearest(gen, ref, gen_desc, ref_desc, name, ann_k, False, ann_backend, memory_budget)[1]
+            ref_nn_dist = nearest(ref, gen, ref_desc, gen_desc, name, ann_k, False, ann_backend, memory_budget)[0]
+            all_nn = nearest(union, union, all_desc, all_desc, name, ann_k, True, ann_backend, memory_budget)[1]
+
+        results["cov_" + name] = len(np.unique(gen_nn)) / K
+        results["mmd_" + name] = float(np.mean(ref_nn_dist))
+        results["1nna_" + name] = float(np.mean(labels[all_nn] == labels))
+    return results
+
+
+if __name__ == "__main__":
+    from preprocess import load_point_clouds, mesh_paths
+    parser = argparse.ArgumentParser(description="evaluate generated Bluenos against the sampled dataset")
+    parser.add_argument("--generated", default=None, help=".npy [M, N, 3] of generated clouds, default: sample the checkpoint")
+    parser.add_argument("--num_generated", type=int, default=960)
+    parser.add_argument("--num_reference", type=int, default=960)
+    parser.add_argument("--num_points", type=int, default=2048)
+    parser.add_argument("--metrics", nargs="+", default=["cd", "emd"], choices=list(metrics))
+    parser.add_argument("--ann_k", type=int, default=None, help="candidates per nearest neighbor search, default exact")
+    parser.add_argument("--ann_backend", default="auto", choices=["auto", "faiss", "exact"])
+    parser.add_argument("--emd_points", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    reference = load_point_clouds(mesh_paths(args.num_reference), args.num_points, seed=args.seed)
+    if args.generated:
+        generated = np.load(args.generated, mmap_mode="r")[:args.num_generated]
+    else:
+        from inference import load_generator
+        G, sphere = load_generator()
+        generated = G.generate(sphere, args.num_generated, seed=args.seed)
+    results = evaluate(generated, reference, args.metrics, args.ann_k, args.ann_backend, args.emd_points, seed=args.seed)
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
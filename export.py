@@ -0,0 +1,53 @@
+import argparse
+import json
+import os
+import tensorflow as tf
+from inference import load_generator, checkpoint_path, latent_dim, num_points
+
+# ====== EXPORT THE TRAINED GENERATOR ===========
+# Writes a self-contained SavedModel (FIXED sphere and its kNN graph baked in as constants, dynamic batch dimension)
+# plus float and dynamic-range quantized TFLite variants. Load them with runtime.py, no training code needed.
+export_dir = "exported_generator"
+
+
+class BluenoSampler(tf.Module):
+    """latent vectors in, point clouds out"""
+    def __init__(self, G, sphere):
+        super(BluenoSampler, self).__init__()
+        self.G = G
+        self.sphere = tf.cast(sphere, tf.float32) # [N,3]
+
+    @tf.function(input_signature=[tf.TensorSpec([None, latent_dim], tf.float32, name="latent_vec")])
+    def generate(self, latent_vec):
+        """
+        latent_vec: [B, latent_dim]
+        returns: {"clouds": [B, N, 3]}
+        """
+        return {"clouds": self.G.infer(self.sphere, latent_vec)}
+
+
+def export(G, sphere, out_dir=export_dir, tflite=True):
+    sampler = BluenoSampler(G, sphere)
+    saved_model_dir = os.path.join(out_dir, "saved_model")
+    tf.saved_model.save(sampler, saved_model_dir, signatures={"serving_default": sampler.generate})
+
+    if tflite:
+        for name, optimizations in [("generator.tflite", []), ("generator_quant.tflite", [tf.lite.Optimize.DEFAULT])]:
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+            converter.optimizations = optimizations
+            with open(os.path.join(out_dir, name), "wb") as f:
+                f.write(converter.convert())
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"latent_dim": latent_dim, "num_points": num_points}, f)
+    print("exported generator to " + out_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export the trained generator for inference")
+    parser.add_argument("--checkpoint", default=checkpoint_path)
+    parser.add_argument("--out", default=export_dir)
+    parser.add_argument("--no_tflite", action="store_true")
+    args = parser.parse_args()
+    G, sphere = load_generator(args.checkpoint)
+    export(G, sphere, args.out, tflite=not args.no_tflite)
@@ -1,10 +1,12 @@
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
 from tensorflow.python.keras.models import Sequential
 from tensorflow.keras.layers import Conv1D, Conv2D, LeakyReLU, Softmax, GlobalMaxPool1D, Dense, Reshape, Embedding, BatchNormalization
 
 class Generator(keras.Model):
-    def __init__(self, num_points, latent_dim, per_point_loss_weight, **kwargs):
+    def __init__(self, num_points, latent_dim, per_point_loss_weight, sphere_nn_idx=None, knn_memory_budget=None,
+                 factored_edge_conv=True, **kwargs):
         super(Generator, self).__init__(name="generator", **kwargs)
         self.feature_emb_sz = 128
         self.style_emb1_sz = 64
@@ -13,6 +15,8 @@ class Generator(keras.Model):
         self.num_points = num_points
         self.latent_dim = latent_dim
         self.per_point_loss_weight = per_point_loss_weight
+        # precomputed kNN graph of the FIXED sphere [N, k] (see sphere.sphere_knn), None to recompute every call
+        self.sphere_nn_idx = sphere_nn_idx
 
         # [B, N, (3+latent_dim)] -> [B,N, feature_emb_sz]
         self.feature_emb = Sequential([
@@ -27,8 +31,12 @@ class Generator(keras.Model):
         self.style_emb2 = Conv1D(2*self.style_emb2_sz, kernel_size=1, input_shape=(num_points, self.style_emb2_sz))
 
         # [B, N, dim_in] -> [B, N, dim_out]
-        self.graph_attn1 = GraphAttention(dim_in=3, dim_out=self.style_emb1_sz, k=20, n=num_points)
-        self.graph_attn2 = GraphAttention(self.style_emb1_sz, self.style_emb2_sz, 20, num_points)
+        # knn_memory_budget (bytes) switches the dynamic kNN to the tiled path for large point counts
+        # factored_edge_conv=False builds the explicit [B, N, k, 2C] edge features (same outputs, more memory)
+        self.graph_attn1 = GraphAttention(dim_in=3, dim_out=self.style_emb1_sz, k=20, n=num_points,
+                                          knn_memory_budget=knn_memory_budget, factored_edge_conv=factored_edge_conv)
+        self.graph_attn2 = GraphAttention(self.style_emb1_sz, self.style_emb2_sz, 20, num_points,
+                                          knn_memory_budget=knn_memory_budget, factored_edge_conv=factored_edge_conv)
 
         self.adaptive_instance_norm1 = AdaptiveInstanceNorm()
         self.adaptive_instance_norm2 = AdaptiveInstanceNorm()
@@ -52,42 +60,79 @@ class Generator(keras.Model):
             LeakyReLU(self.leaky_grad),
             Conv1D(64, kernel_size=1),
             LeakyReLU(self.leaky_grad),
-            Conv1D(3, kernel_size=1, activation='tanh'),
+            Conv1D(3, kernel_size=1, activation='tanh', dtype='float32'), # float32 output under mixed precision
         ])
-    def call(self, sphere, latent_vec):
+    def call(self, sphere, latent_vec, style_slot=None):
         """
         sphere: [B, N, 3]
         latent_vec: [B, latent_dim]
+        style_slot: if set, every cloud uses this training batch slot of the AdaIN weights, which makes each output
+                    independent of the batch size and of its position in the batch (see AdaptiveInstanceNorm)
 
         Returns: generated point cloud [B, N,3]
         """
         # 1) upper branch: get local style embedding from prior latent matrix
+        latent_vec = tf.cast(latent_vec, sphere.dtype) # only the sphere is autocast under mixed precision
         latent_vecs = tf.expand_dims(latent_vec, 1) # [B, 1, latent_dim]
         latent_vecs = tf.repeat(latent_vecs, self.num_points, axis=1) # [B,N, latent_dim]
         latent_matrix = tf.concat([sphere, latent_vecs], axis=-1) # [B,N, 3+latent_dim]
         feature_emb = self.feature_emb(latent_matrix) # [B,N, feature_emb_sz]
         local_style1 = self.style_emb1(feature_emb) # [B,N, 2*style_emb1_sz]
         # 2) lower branch: apply graph attention module to get feature map
-        feature_map = self.graph_attn1(sphere) # [B, N, 64]
+        feature_map = self.graph_attn1(sphere, nn_idx=self.sphere_nn_idx) # [B, N, 64]
         
         # 3) get embedded feature map: fuse local style with global feature map
-        normalized_feature_map = self.adaptive_instance_norm1(feature_map, local_style1) # [B, N, 64]
+        normalized_feature_map = self.adaptive_instance_norm1(feature_map, local_style1, slot=style_slot) # [B, N, 64]
         
         # repeat 1-3
         local_style2 = self.style_emb2(feature_emb) # [B,N, 2*style_emb2_sz]
         feature_map2 = self.graph_attn2(normalized_feature_map) # [B, N, 128]
-        normalized_feature_map2 = self.adaptive_instance_norm2(feature_map2, local_style2) # [B, N, 128]
+        normalized_feature_map2 = self.adaptive_instance_norm2(feature_map2, local_style2, slot=style_slot) # [B, N, 128]
         
         # reconstruct point cloud from new embedded feature map
-        pooled_features = self.max_pool(normalized_feature_map2) # [B, 1, 128]
+        pooled_features = self.max_pool(normalized_feature_map2) # [B, 128]
 
-        global_features = self.global_feature_MLP(tf.squeeze(pooled_features)) # [B, 512]
+        global_features = self.global_feature_MLP(pooled_features) # [B, 512]
         global_features = tf.expand_dims(global_features, 1) # [B, 1, 512]
         duplicated_features = tf.repeat(global_features, self.num_points, axis=1) # [B, N, 512]
         concat = tf.concat([normalized_feature_map2, duplicated_features], axis=-1) # [B, N, (512+128)]
 
         return self.MLP_out(concat) # [B, N,3]
 
+    @tf.function(input_signature=[tf.TensorSpec([None, 3], tf.float32), tf.TensorSpec([None, None], tf.float32)])
+    def infer(self, sphere, latent_vec):
+        """
+        Inference forward pass for any batch size (including 1), traced once.
+        Every cloud uses the AdaIN weights of batch slot 0, so a cloud only depends on its own latent vector.
+        The model must already be built with the training batch size (e.g. restored from a checkpoint).
+
+        sphere: the FIXED sphere [N, 3]
+        latent_vec: [B, latent_dim]
+        Returns: generated point clouds [B, N, 3]
+        """
+        spheres = tf.broadcast_to(sphere, [tf.shape(latent_vec)[0], tf.shape(sphere)[0], 3]) # [B,N,3]
+        return self(spheres, latent_vec, style_slot=0)
+
+    def generate(self, sphere, n, seed=None, max_batch=16):
+        """
+        n new clouds from latent vectors drawn from N(0,1) with the given seed.
+        Cloud i only depends on (seed, i), not on how the request is batched.
+        Returns: np array [n, N, 3]
+        """
+        latent_vecs = np.random.default_rng(seed).standard_normal([n, self.latent_dim]).astype(np.float32)
+        return self.generate_from_latents(sphere, latent_vecs, max_batch)
+
+    def generate_from_latents(self, sphere, latent_vecs, max_batch=16):
+        """
+        latent_vecs: [n, latent_dim], split into the fewest, evenly sized forward passes of at most max_batch
+        Returns: np array [n, N, 3]
+        """
+        n = len(latent_vecs)
+        num_batches = max(1, -(-n // max_batch))
+        batch_size = max(1, -(-n // num_batches))
+        sphere = tf.cast(sphere, tf.float32)
+        clouds = [self.infer(sphere, latent_vecs[i:i+batch_size]).numpy() for i in range(0, n, batch_size)]
+        return np.concatenate(clouds) if clouds else np.zeros([0, self.num_points, 3], np.float32)
 
     def loss(self, fake_shape_scores, fake_per_point_scores):
         shape_loss = 0.5 * (fake_shape_scores-1)**2 # [B, 1]
@@ -98,12 +143,16 @@ class Generator(keras.Model):
         return tf.reduce_sum(shape_loss +  self.per_point_loss_weight * point_loss)
 # helper classes
 class GraphAttention(keras.layers.Layer):
-    def __init__(self, dim_in, dim_out, k, n, **kwargs):
+    def __init__(self, dim_in, dim_out, k, n, knn_memory_budget=None, factored_edge_conv=True, **kwargs):
         super(GraphAttention, self).__init__(name="graph_attn", **kwargs)
 
         self.k = k #20
         self.dim_in = dim_in
         self.dim_out = dim_out
+        # max bytes for the kNN distances; None builds the full [B, N, N] matrix at once
+        self.knn_memory_budget = knn_memory_budget
+        # apply the first (linear) conv of both MLPs per point before grouping, see factored_edge_mlps
+        self.factored_edge_conv = factored_edge_conv
         
         
         # upper branch
@@ -124,7 +173,7 @@ class GraphAttention(keras.layers.Layer):
             Conv2D(dim_out, kernel_size=1, strides=1), # (B, N, k, dim_out)
             BatchNormalization(axis=-1), # channel last 
             LeakyReLU(0.01),
-            Softmax(axis=2)  #softmax along k axis
+            Softmax(axis=2, dtype='float32')  #softmax along k axis, float32 under mixed precision
         ])
 
         # [B,N,k,C] -> [B,N, dim_out]
@@ -133,60 +182,108 @@ class GraphAttention(keras.layers.Layer):
         ])
 
 
-    def call(self, x):
+    def call(self, x, nn_idx=None):
         """
         x: point cloud input [batch, N, C] where C is the dimension of the points in the cloud (C=3 initially)
+        nn_idx: optional static neighborhood [N, k] shared by every cloud in the batch (e.g. the fixed sphere).
+                If None, the kNN graph is rebuilt from x
         returns: point-wise feature map [B, N, dim_out]
         """
-        batch_sz = x.shape[0]
-        # KNN grouping (lower branch)
-        dist_adj_matrix = self.pairwise_distance(x) # builds adj matrix [B, N, N] as indices
-        # assert dist_adj_matrix.shape == (batch_sz, 1024, 1024)
-
-        nn_idx = self.knn(dist_adj_matrix) # [B, N, k]
-        # assert nn_idx.shape == (batch_sz, 1024, self.k)
+        # neighbors are always searched in float32, reduced precision distances reorder them
+        if nn_idx is None and self.knn_memory_budget is not None:
+            # KNN grouping (lower branch), streamed over row blocks of the adj matrix
+            nn_idx = self.knn_tiled(tf.cast(x, tf.float32), self.k, self.knn_memory_budget) # [B, N, k]
+        elif nn_idx is None:
+            # KNN grouping (lower branch)
+            dist_adj_matrix = self.pairwise_distance(tf.cast(x, tf.float32)) # builds adj matrix [B, N, N] as indices
+            # assert dist_adj_matrix.shape == (batch_sz, 1024, 1024)
+
+            nn_idx = self.knn(dist_adj_matrix, self.k) # [B, N, k]
+            # assert nn_idx.shape == (batch_sz, 1024, self.k)
         
-        upper_branch, lower_branch = self.get_edge_feature(tf.expand_dims(x, axis=2), nn_idx) # [B, N, k, 2C], [B, N, k, C]
-        # assert upper_branch.shape == (batch_sz, 1024, self.k, 2*x.shape[-1])
-        # assert lower_branch.shape == (batch_sz, 1024, self.k, x.shape[-1])
+        if self.factored_edge_conv:
+            feature_map, feature_weights = self.factored_edge_mlps(x, nn_idx) # [B, N, k, dim_out] each
+        else:
+            upper_branch, lower_branch = self.get_edge_feature(tf.expand_dims(x, axis=2), nn_idx, self.k) # [B, N, k, 2C], [B, N, k, C]
+            # assert upper_branch.shape == (batch_sz, 1024, self.k, 2*x.shape[-1])
+            # assert lower_branch.shape == (batch_sz, 1024, self.k, x.shape[-1])
 
-        # apply MLPs (EdgeConv) to both branches
-        feature_map = self.MLPs_upper(upper_branch) # [B, N, k, dim_out]
-        feature_weights = self.MLPs_lower(lower_branch) # [B, N, k, dim_out]
+            # apply MLPs (EdgeConv) to both branches
+            feature_map = self.MLPs_upper(upper_branch) # [B, N, k, dim_out]
+            feature_weights = self.MLPs_lower(lower_branch) # [B, N, k, dim_out]
 
         # collapse upper/lower branches
-        weighted_feature_map = feature_map * feature_weights # [B, N, k, dim_out]
+        weighted_feature_map = feature_map * tf.cast(feature_weights, feature_map.dtype) # [B, N, k, dim_out]
         out = self.conv_out(weighted_feature_map) # [B, N, 1, dim_out]
-        return tf.squeeze(out)
+        return tf.squeeze(out, axis=2)
 
     
+    def factored_edge_mlps(self, x, nn_idx):
+        """
+        MLPs_upper(edge features) and MLPs_lower(neighbors) without building the edge features.
+        The first 1x1 conv of each MLP is linear, so on edge (i, j)
+            W·[x_i, x_j - x_i] + b = ((W_i - W_j)·x_i + b) + W_j·x_j   (W = [W_i; W_j] split by input channel)
+        and both are computed per point; only the W_j·x_j terms (and the lower conv of x_j) are grouped, the
+        x_i term is broadcast over the k neighbors. Uses the same Conv2D weights as the explicit path.
+        x: [B, N, C]
+        nn_idx: [B, N, k] or [N, k]
+        returns: upper and lower branch outputs, [B, N, k, dim_out] each
+        """
+        num_dims = x.shape[-1]
+        upper_conv, lower_conv = self.MLPs_upper.layers[0], self.MLPs_lower.layers[0]
+        for conv, channels in [(upper_conv, 2*num_dims), (lower_conv, num_dims)]:
+            if not conv.built:
+                conv.build(tf.TensorShape([None, None, self.k, channels]))
+        upper_kernel = tf.cast(upper_conv.kernel[0, 0], x.dtype) # [2C, dim_out]
+        lower_kernel = tf.cast(lower_conv.kernel[0, 0], x.dtype) # [C, dim_out]
+        central_kernel, neighbor_kernel = upper_kernel[:num_dims], upper_kernel[num_dims:]
+
+        central = tf.einsum("bnc,cd->bnd", x, central_kernel - neighbor_kernel) + tf.cast(upper_conv.bias, x.dtype) # [B, N, dim_out]
+        neighbor = tf.einsum("bnc,cd->bnd", x, neighbor_kernel) # [B, N, dim_out]
+        lower = tf.einsum("bnc,cd->bnd", x, lower_kernel) + tf.cast(lower_conv.bias, x.dtype) # [B, N, dim_out]
+        feature_map = self.gather_neighbors(neighbor, nn_idx) + tf.expand_dims(central, axis=2) # [B, N, k, dim_out], x_i term broadcast over k
+        feature_weights = self.gather_neighbors(lower, nn_idx) # [B, N, k, dim_out]
+
+        # rest of the MLPs (BN, LeakyReLU, Softmax) is pointwise
+        for layer in self.MLPs_upper.layers[1:]:
+            feature_map = layer(feature_map)
+        for layer in self.MLPs_lower.layers[1:]:
+            feature_weights = layer(feature_weights)
+        return feature_map, feature_weights
+
+    @staticmethod
+    def gather_neighbors(point_cloud, nn_idx):
+        """
+        point_cloud: [B, N, C]
+        nn_idx: [B, N, k] or [N, k] if shared by the whole batch
+        returns: [B, N, k, C]
+        """
+        if len(nn_idx.shape) == 2:
+            # static neighborhood: same indices for every cloud in the batch
+            return tf.gather(point_cloud, nn_idx, axis=1) #KNN grouping
+        point_cloud_shape = tf.shape(point_cloud) # dynamic so any batch size works
+        batch_size = point_cloud_shape[0]
+        num_points = point_cloud_shape[1]
+        idx_ = tf.range(batch_size) * num_points
+        idx_ = tf.reshape(idx_, [batch_size, 1, 1]) 
+
+        point_cloud_flat = tf.reshape(point_cloud, [-1, point_cloud.shape[2]])
+        return tf.gather(point_cloud_flat, nn_idx+idx_) #KNN grouping
+
     # ===== EdgeConv module from DGCNN ==============
     def get_edge_feature(self, point_cloud, nn_idx, k=20):
         """Construct edge feature for each point
         Args:
             point_cloud: (batch_size, num_points, 1, num_dims)
-            nn_idx: (batch_size, num_points, k)
+            nn_idx: (batch_size, num_points, k) or (num_points, k) if shared by the whole batch
             k: int
         Returns:
             edge features: (batch_size, num_points, k, 2*num_dims)
         """
-        og_batch_size = point_cloud.shape[0]
-        point_cloud = tf.squeeze(point_cloud)
-        if og_batch_size == 1:
-            point_cloud = tf.expand_dims(point_cloud, 0)
+        point_cloud = tf.squeeze(point_cloud, axis=2)
 
         point_cloud_central = point_cloud
-
-        point_cloud_shape = point_cloud.shape
-        batch_size = point_cloud_shape[0]
-        num_points = point_cloud_shape[1]
-        num_dims = point_cloud_shape[2]
-
-        idx_ = tf.range(batch_size) * num_points
-        idx_ = tf.reshape(idx_, [batch_size, 1, 1]) 
-
-        point_cloud_flat = tf.reshape(point_cloud, [-1, num_dims])
-        point_cloud_neighbors = tf.gather(point_cloud_flat, nn_idx+idx_) #KNN grouping
+        point_cloud_neighbors = self.gather_neighbors(point_cloud, nn_idx)
         point_cloud_central = tf.expand_dims(point_cloud_central, axis=-2)
 
         point_cloud_central = tf.tile(point_cloud_central, [1, 1, k, 1]) #duplicate k times
@@ -194,18 +291,14 @@ class GraphAttention(keras.layers.Layer):
         edge_feature = tf.concat([point_cloud_central, point_cloud_neighbors-point_cloud_central], axis=-1)
         return edge_feature, point_cloud_neighbors
 
-    def pairwise_distance(self, point_cloud):
+    @staticmethod
+    def pairwise_distance(point_cloud):
         """Compute pairwise distance of a point cloud.
         Args:
             point_cloud: tensor (batch_size, num_points, num_dims)
         Returns:
             pairwise distance: (batch_size, num_points, num_points)
         """
-        og_batch_size = point_cloud.shape[0]
-        point_cloud = tf.squeeze(point_cloud)
-        if og_batch_size == 1:
-            point_cloud = tf.expand_dims(point_cloud, 0)
-            
         point_cloud_transpose = tf.transpose(point_cloud, perm=[0, 2, 1])
         point_cloud_inner = tf.matmul(point_cloud, point_cloud_transpose)
         point_cloud_inner = -2*point_cloud_inner
@@ -213,7 +306,8 @@ class GraphAttention(keras.layers.Layer):
         point_cloud_square_tranpose = tf.transpose(point_cloud_square, perm=[0, 2, 1])
         return point_cloud_square + point_cloud_inner + point_cloud_square_tranpose
 
-    def knn(self, adj_matrix, k=20):
+    @staticmethod
+    def knn(adj_matrix, k=20):
         """Get KNN based on the pairwise distance.
         Args:
             pairwise distance: (batch_size, num_points, num_points)
@@ -225,6 +319,52 @@ class GraphAttention(keras.layers.Layer):
         _, nn_idx = tf.nn.top_k(neg_adj, k=k)
         return nn_idx
 
+    @staticmethod
+    def knn_tile_size(batch_size, num_points, memory_budget):
+        """Number of query rows per block so that one (batch_size, tile, num_points) float32 block fits the budget"""
+        block_bytes = 4 * tf.cast(batch_size, tf.int64) * tf.cast(num_points, tf.int64)
+        tile = tf.cast(tf.constant(memory_budget, tf.int64) // block_bytes, tf.int32)
+        return tf.clip_by_value(tile, 1, num_points)
+
+    @staticmethod
+    def knn_tiled(point_cloud, k=20, memory_budget=256*2**20):
+        """Get KNN without materialising the full pairwise distance matrix.
+        Row blocks of queries are scored against the whole cloud one at a time and only their top k is kept,
+        so peak memory is (batch_size, tile, num_points) instead of (batch_size, num_points, num_points).
+        Gives the same indices as knn(pairwise_distance(point_cloud)).
+        Args:
+            point_cloud: tensor (batch_size, num_points, num_dims)
+            k: int
+            memory_budget: bytes allowed for one block of distances, sets the tile size
+        Returns:
+            nearest neighbors: (batch_size, num_points, k)
+        """
+        shape = tf.shape(point_cloud)
+        batch_size, num_points, num_dims = shape[0], shape[1], shape[2]
+        tile = GraphAttention.knn_tile_size(batch_size, num_points, memory_budget)
+        num_tiles = (num_points + tile - 1) // tile
+
+        point_cloud_square = tf.reduce_sum(tf.square(point_cloud), axis=-1, keepdims=True) # [B, N, 1]
+        point_cloud_square_tranpose = tf.transpose(point_cloud_square, perm=[0, 2, 1]) # [B, 1, N]
+
+        # pad the queries to a whole number of tiles, [num_tiles, B, tile, C]
+        queries = tf.pad(point_cloud, [[0, 0], [0, num_tiles*tile - num_points], [0, 0]])
+        queries = tf.reshape(queries, [batch_size, num_tiles, tile, num_dims])
+        queries = tf.transpose(queries, perm=[1, 0, 2, 3])
+
+        def block_knn(query_block):
+            # same expansion as pairwise_distance, restricted to `tile` rows
+            block_inner = -2*tf.matmul(query_block, point_cloud, transpose_b=True) # [B, tile, N]
+            block_square = tf.reduce_sum(tf.square(query_block), axis=-1, keepdims=True) # [B, tile, 1]
+            block_adj = block_square + block_inner + point_cloud_square_tranpose
+            _, block_idx = tf.nn.top_k(-block_adj, k=k)
+            return block_idx # [B, tile, k]
+
+        # one block at a time so only a single [B, tile, N] block is alive
+        nn_idx = tf.map_fn(block_knn, queries, fn_output_signature=tf.int32, parallel_iterations=1) # [num_tiles, B, tile, k]
+        nn_idx = tf.reshape(tf.transpose(nn_idx, perm=[1, 0, 2, 3]), [batch_size, num_tiles*tile, k])
+        return nn_idx[:, :num_points]
+
 
 
 class AdaptiveInstanceNorm(keras.layers.Layer):
@@ -234,14 +374,24 @@ class AdaptiveInstanceNorm(keras.layers.Layer):
         self.norm = BatchNormalization(axis=[0,1])
 
 
-    def call(self, feature_map, styles, training=True):
+    def call(self, feature_map, styles, training=True, slot=None):
         """
         feature_map: output of graph attention, [B, N, dim_graph_attn_out]
         styles: output of style embedding, [B,N, 2*style_emb_sz]
+        slot: optional training batch slot whose norm weights are used for every instance.
+              self.norm keeps a gamma/beta per (batch slot, point), so without a slot B must equal the training batch size
         returns: normalized feature map (same size)
         """
         # split styles into scale and bias scalars
         scale, bias = tf.split(styles, 2, axis=-1) # each [B, N, style_emb_sz]
         # print("scale, bias:", scale.shape, bias.shape)
         # print("norm: ", self.norm(feature_map).shape)
-        return scale * self.norm(feature_map) + bias
\ No newline at end of file
+        if slot is None:
+            normalized = self.norm(feature_map) # computes in float32 even under mixed precision
+        else:
+            # same per-instance normalization self.norm does in training mode, for any batch size
+            feature_map = tf.cast(feature_map, tf.float32)
+            mean, variance = tf.nn.moments(feature_map, axes=[-1], keepdims=True) # [B, N, 1]
+            normalized = tf.nn.batch_normalization(feature_map, mean, variance,
+                tf.cast(self.norm.beta[slot], tf.float32), tf.cast(self.norm.gamma[slot], tf.float32), self.norm.epsilon) # gamma/beta [N, 1]
+        return scale * tf.cast(normalized, scale.dtype) + bias
\ No newline at end of file
@@ -1,9 +1,9 @@
 import tensorflow as tf
 import trimesh
 import trimesh.exchange.xyz, trimesh.points
-from discriminator import Discriminator
 from generator import Generator
-import numpy as np
+from sphere import load_sphere, sphere_knn
+from interpolation import interpolate_latents
 
 num_examples = 5
 interpolation_steps = 4
@@ -14,59 +14,56 @@ batch_sz = 16 # MUST MATCH TRAINING
 per_point_loss_weight = 0.4 # MUST MATCH TRAINING
 num_points = 2048 # MUST MATCH TRAINING
 latent_dim = 100 #85 # MUST MATCH TRAINING
+knn_memory_budget = None # bytes per block of kNN distances, None = dense (does not change the outputs)
+checkpoint_path = "trained_generator"
 
 
-# read in FIXED sphere points
-file = open("sphere_" + str(num_points) +"_points.xyz")
-sphere = trimesh.exchange.xyz.load_xyz(file)['vertices'] #verts only
-sphere = tf.reshape(sphere, [num_points, 3]) #[N,3]
+def load_generator(checkpoint_path=checkpoint_path):
+    """
+    builds the Generator and restores the trained weights
+    returns: G, FIXED sphere [N,3]
+    """
+    # read in FIXED sphere points and its (cached) kNN graph
+    sphere = load_sphere(num_points) #[N,3]
+    sphere_nn_idx = sphere_knn(num_points) #[N,k]
 
-# load in model
-D = Discriminator(num_points, per_point_loss_weight)
-G = Generator(num_points, latent_dim, per_point_loss_weight)
+    # load in model
+    G = Generator(num_points, latent_dim, per_point_loss_weight, sphere_nn_idx=sphere_nn_idx, knn_memory_budget=knn_memory_budget)
 
-# run model once to configure for restoring
-noise = tf.random.normal([batch_sz, latent_dim], 0, 1)
-spheres = tf.repeat(tf.expand_dims(sphere, axis=0), batch_sz, axis=0) #[B,N,3]
-fake_clouds = G(spheres, noise)
+    # run model once with the training batch size to configure for restoring
+    noise = tf.random.normal([batch_sz, latent_dim], 0, 1)
+    spheres = tf.repeat(tf.expand_dims(sphere, axis=0), batch_sz, axis=0) #[B,N,3]
+    G(spheres, noise)
 
-checkpoint = tf.train.Checkpoint(G=G)
-checkpoint_path = "trained_generator"
-print("loading checkpoint at " + tf.train.latest_checkpoint(checkpoint_path))
-status = checkpoint.restore(tf.train.latest_checkpoint(checkpoint_path))  #   
-status.assert_consumed() # assert that all params loaded
+    checkpoint = tf.train.Checkpoint(G=G)
+    print("loading checkpoint at " + tf.train.latest_checkpoint(checkpoint_path))
+    status = checkpoint.restore(tf.train.latest_checkpoint(checkpoint_path)).expect_partial() # training checkpoints also hold D, optimizers, ...
+    status.assert_existing_objects_matched() # assert that all params loaded
+    return G, sphere
 
 
 # returns np array of blueno coords
-def getBlueno(noise):
-    blueno = G(spheres, noise)
-    blueno = tf.make_tensor_proto(tf.squeeze(blueno))
-    blueno = tf.make_ndarray(blueno)[0]
-    return blueno
+def getBlueno(G, sphere, noise):
+    """noise: [1, latent_dim], costs a single forward pass of size one"""
+    return G.infer(tf.cast(sphere, tf.float32), noise)[0].numpy()
 
-# generate 2 distinct bluenos
-spheres = tf.repeat(tf.expand_dims(sphere, axis=0), batch_sz, axis=0) #[B,N,3]
-noise1 = tf.random.normal([batch_sz, latent_dim], 0, 0.5)
-noise2 = tf.random.normal([batch_sz, latent_dim], 0, 3)
 
-blueno1 = getBlueno(noise1)
-blueno2 = getBlueno(noise2)
+if __name__ == "__main__":
+    G, sphere = load_generator()
 
-print("interpolating:")
-# interpolate
-for i in range(interpolation_steps):
-    a = float(i)/interpolation_steps
-    intermediate_blueno = (1-a)*blueno1 + a*blueno2
-    intermediate_blueno = trimesh.points.PointCloud(intermediate_blueno)
-    intermediate_blueno.show()
+    # latent vectors of 2 distinct bluenos
+    noise1 = tf.random.normal([1, latent_dim], 0, 0.5)
+    noise2 = tf.random.normal([1, latent_dim], 0, 3)
 
-# visualize each cloud
-print("showing random bluenos:")
-fake_clouds = G(spheres, noise)
-for i, cloud in enumerate(tf.unstack(fake_clouds)):
-    cloud = tf.make_tensor_proto(cloud)
-    cloud = trimesh.points.PointCloud(tf.make_ndarray(cloud))
-    cloud.show()
-    if i == batch_sz-1 or i == num_examples:
-        break
+    print("interpolating:")
+    # interpolate in latent space, all steps in one forward pass
+    latents = interpolate_latents(tf.concat([noise1, noise2], axis=0).numpy(), interpolation_steps+1, mode="linear")
+    for intermediate_blueno in G.generate_from_latents(sphere, latents[:-1]):
+        intermediate_blueno = trimesh.points.PointCloud(intermediate_blueno)
+        intermediate_blueno.show()
 
+    # visualize each cloud
+    print("showing random bluenos:")
+    for cloud in G.generate(sphere, num_examples):
+        cloud = trimesh.points.PointCloud(cloud)
+        cloud.show()
@@ -0,0 +1,75 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# ====== LATENT SPACE INTERPOLATION ===========
+# Paths through several latent anchors; every frame is generated in a few large batched forward passes
+# and streamed into a single [frames, N, 3] .npy file.
+
+
+def slerp(z0, z1, a):
+    """
+    spherical interpolation between rows of z0 and z1 [F, latent_dim] at fractions a [F, 1]
+    falls back to linear interpolation for (nearly) parallel vectors
+    """
+    cos = np.sum(z0 * z1, axis=-1, keepdims=True) / (np.linalg.norm(z0, axis=-1, keepdims=True) * np.linalg.norm(z1, axis=-1, keepdims=True))
+    omega = np.arccos(np.clip(cos, -1, 1))
+    sin = np.sin(omega)
+    safe_sin = np.where(sin < 1e-6, 1, sin)
+    spherical = (np.sin((1-a) * omega) * z0 + np.sin(a * omega) * z1) / safe_sin
+    return np.where(sin < 1e-6, (1-a) * z0 + a * z1, spherical)
+
+
+def interpolate_latents(anchors, frames, mode="slerp"):
+    """
+    anchors: [A, latent_dim], A >= 2 latent vectors the path passes through (first and last frame are anchors)
+    mode: "linear" or "slerp"
+    returns: [frames, latent_dim] (float32)
+    """
+    anchors = np.asarray(anchors, dtype=np.float64)
+    t = np.linspace(0, len(anchors) - 1, frames)
+    segment = np.minimum(t.astype(int), len(anchors) - 2)
+    a = (t - segment)[:, None] # [F, 1]
+    z0, z1 = anchors[segment], anchors[segment + 1]
+    if mode == "linear":
+        latents = (1-a) * z0 + a * z1
+    elif mode == "slerp":
+        latents = slerp(z0, z1, a)
+    else:
+        raise ValueError("unknown interpolation mode " + mode)
+    return latents.astype(np.float32)
+
+
+def sweep(G, sphere, anchors, frames, out_path, mode="slerp", max_batch=64):
+    """
+    generates every frame of the path through anchors and streams them to out_path
+    returns: memory-mapped frames [frames, N, 3]
+    """
+    latents = interpolate_latents(anchors, frames, mode)
+    np.save(out_path.replace(".npy", "") + "_latents.npy", latents)
+
+    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=(frames, G.num_points, 3))
+    num_batches = -(-frames // max_batch)
+    batch_size = -(-frames // num_batches)
+    sphere = tf.cast(sphere, tf.float32)
+    for i in range(0, frames, batch_size):
+        out[i:i+batch_size] = G.infer(sphere, latents[i:i+batch_size]).numpy()
+    out.flush()
+    return out
+
+
+if __name__ == "__main__":
+    from inference import load_generator, latent_dim
+    parser = argparse.ArgumentParser(description="render a latent space sweep through random anchors")
+    parser.add_argument("--anchors", type=int, default=2)
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--mode", default="slerp", choices=["linear", "slerp"])
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--out", default="sweep.npy")
+    args = parser.parse_args()
+
+    G, sphere = load_generator()
+    anchors = np.random.default_rng(args.seed).standard_normal([args.anchors, latent_dim])
+    sweep(G, sphere, anchors, args.frames, args.out, args.mode, args.max_batch)
+    print("wrote", args.frames, "frames to", args.out)
@@ -1,11 +1,14 @@
 import tensorflow as tf
 import tensorflow.keras as keras
-from matplotlib import pyplot
-import trimesh
-import trimesh.exchange.xyz, trimesh.points
+import time
 from discriminator import Discriminator
 from generator import Generator
-import numpy as np
+from sphere import load_sphere, sphere_knn
+from preprocess import load_point_clouds, load_triangle_tables, make_resampling_dataset, mesh_paths
+from telemetry import MetricsLogger
+from distributed import make_strategy, task_dir
+from checkpointing import TrainingCheckpoint
+from evaluation import evaluate
 
 
 # ====== GLOBAL HYPERPARAMS ===========
@@ -15,108 +18,243 @@ learning_rate_g = 0.0001
 learning_rate_d = 0.0001
 per_point_loss_weight = 0.4
 num_points = 2048 #1024 or 2048
+knn_memory_budget = None # bytes per block of kNN distances (e.g. 256*2**20 for 8k+ points), None = dense
 latent_dim = 100
 num_examples = 960
-d_optimizer = keras.optimizers.Adam(learning_rate_d, beta_1=0.5)
-g_optimizer = keras.optimizers.Adam(learning_rate_g, beta_1=0.5)
+data_seed = 0 # seed for sampling the meshes into point clouds
+resample_every_epoch = True # draw new surface points each epoch instead of fixing one sample per mesh
+log_every = 2 # batches per logged (mean) loss; view with: python telemetry.py plot training_logs/metrics.jsonl
+log_dir = "training_logs"
+fast_training = False # opt-in mixed precision + XLA-compiled train step (parity/throughput: python precision_check.py)
+mixed_precision_policy = "mixed_float16" # "mixed_bfloat16" is usually the faster choice on recent CPUs
+fuse_discriminator = False # score real and fake clouds in one D pass (same scores, D's BatchNorms use moving stats)
+reuse_generator_forward = False # one G forward per step, the G update reuses the D update's fakes (and noise)
+distribution = None # None (one device), "mirrored" (local devices) or "multi_worker" (hosts in TF_CONFIG), see distributed.py
+num_cpu_replicas = 1 # "mirrored" on CPU: number of logical devices (replicas) the cores are split into
+train_seed = 0 # seed of the latent noise RNG (saved in the checkpoints, so resumed runs continue the same stream)
+checkpoint_dir = "training_checkpoints2" # full training state, training resumes from the latest one in here
+checkpoint_every = 100 # batches between checkpoints (also saved at the end of every epoch)
+keep_checkpoints = 3
+best_metric = "g_loss" # the checkpoint with the lowest epoch mean of this metric (or eval result, e.g. "mmd_cd") is kept in <checkpoint_dir>/best
+eval_every = 0 # epochs between evaluations against real clouds (COV/MMD/1-NNA, see evaluation.py), 0 = never
+eval_samples = 256 # generated (fixed latents) and real clouds compared per evaluation
+eval_metrics = ["cd"] # add "emd" for the (slower) Sinkhorn EMD
+eval_ann_k = 10 # nearest neighbor candidates per cloud, None = exact
+async_checkpoints = True # write checkpoints in the background
 
 
-# ====== DATA PREPROCESSING ========
-# read in meshes and convert to point clouds
-data = []
-for i in range(num_examples):
-    path = "./blueno/blueno" + str(i) + ".stl" 
-    mesh = trimesh.load(path)
-    data.append(mesh.sample(num_points)) #[N,3]
+# ====== SINGLE TRAINING STEP ===============
+def make_train_batch(G, D, g_optimizer, d_optimizer, sphere, batch_sz, latent_dim, jit_compile=False,
+                     fuse_discriminator=False, reuse_generator_forward=False, strategy=None, rng=None):
+    """
+    builds the training step for the given models/optimizers.
+    If the optimizers are keras.mixed_precision.LossScaleOptimizer the losses are scaled before differentiating.
+    strategy: tf.distribute strategy the models/optimizers were built under, every replica trains on batch_sz
+              clouds (the step then takes a distributed batch of batch_sz * replicas)
+    fuse_discriminator: score [real; fake] as one batch of 2B. D is always called in inference mode, so its
+                        BatchNorms normalize each cloud with the moving statistics and the halves don't interact
+    reuse_generator_forward: run G once per step and backprop the G loss through those fakes (scored by the
+                             updated D) instead of generating a second batch from fresh noise
+    rng: tf.random.Generator (created under the strategy) for the latent noise so checkpoints can save its state,
+         None draws from the global (unsaved) RNG
+    fuse_discriminator=False, reuse_generator_forward=False is the original step
+    """
+    strategy = strategy or tf.distribute.get_strategy()
 
-# convert data to TF Dataset object and batch
-dataset = tf.data.Dataset.from_tensor_slices(data)
-dataset = dataset.shuffle(buffer_size=num_examples).batch(batch_sz, drop_remainder=True)
+    def scale_loss(loss, optimizer):
+        """must be called inside the tape"""
+        # gradients are summed over the replicas: scale by batch_sz / global batch so a step matches one device's
+        loss = loss / strategy.num_replicas_in_sync
+        if isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+            return optimizer.get_scaled_loss(loss)
+        return loss
 
-# read in FIXED sphere points
-file = open("sphere_" + str(num_points) +"_points.xyz")
-sphere = trimesh.exchange.xyz.load_xyz(file)['vertices'] #verts only
-sphere = tf.reshape(sphere, [num_points, 3]) #[N,3]
+    def apply_gradients(tape, scaled_loss, model, optimizer):
+        grads = tape.gradient(scaled_loss, model.trainable_variables)
+        if isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+            grads = optimizer.get_unscaled_gradients(grads)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
 
+    def sample_noise():
+        # sample random latent vects from N(0,1)
+        if rng is not None:
+            return rng.normal([batch_sz, latent_dim])
+        return tf.random.normal([batch_sz, latent_dim])
 
-# ====== SINGLE TRAINING STEP ===============
-@tf.function
-def train_batch(real_clouds):
-    """
-    trains D and G successively for one batch
-    
-    real_clouds: [B, N, 3]
-    returns: d_loss (scalar), g_loss (scalar), generated_clouds [B,N,3]
-    """
-    # sample random latent vects from N(0,1)
-    noise = tf.random.normal([batch_sz, latent_dim])
-    spheres = tf.repeat(tf.expand_dims(sphere, axis=0), batch_sz, axis=0) #[B,N,3]
-    # generate fake images
-    fake_clouds = G(spheres, noise)
-
-    # train D with real and fake clouds
-    with tf.GradientTape() as tape:
-        real_shape_score, real_per_point_score = D(real_clouds)
-        fake_shape_score, fake_per_point_score = D(fake_clouds)
-        # print("real score: ", real_shape_score)
-        # print("fake score: ", fake_shape_score)
-        d_loss = D.loss(real_shape_score, real_per_point_score, fake_shape_score, fake_per_point_score)
-    grads = tape.gradient(d_loss, D.trainable_variables)
-    d_optimizer.apply_gradients(zip(grads, D.trainable_variables))
-
-    noise = tf.random.normal([batch_sz, latent_dim])
-    # train G with fake clouds
-    with tf.GradientTape() as tape:
-        fake_shape_score, fake_per_point_score = D(G(spheres, noise))
-        g_loss = G.loss(fake_shape_score, fake_per_point_score)
-    grads = tape.gradient(g_loss, G.trainable_variables)
-    g_optimizer.apply_gradients(zip(grads, G.trainable_variables))
-    
-    return d_loss, g_loss, fake_clouds
-
-
-# ====== MAIN LOOP ==========
-D = Discriminator(num_points, per_point_loss_weight)
-G = Generator(num_points, latent_dim, per_point_loss_weight)
-# checkpoints to occasionally save model (generator only)
-checkpoint = tf.train.Checkpoint(G=G) 
-checkpoint_dir_prefix = "training_checkpoints2/checkpoint"
-G_losses = []
-D_losses = []
-
-for epoch in range(epochs):
-    print("================ Epoch: ", epoch)
-    for batch_num, real_cloud_batch in enumerate(dataset):
-        print("--------batch: ", batch_num)
-        d_loss, g_loss, generated_clouds = train_batch(real_cloud_batch)
-
-        if batch_num % 2:
-            print("d_loss: ", d_loss)
-            print("g_loss: ", g_loss)
-            G_losses.append(g_loss)
-            D_losses.append(d_loss)
+    def score(real_clouds, fake_clouds):
+        """returns: real_shape_score, real_per_point_score, fake_shape_score, fake_per_point_score"""
+        if fuse_discriminator:
+            shape_score, per_point_score = D(tf.concat([real_clouds, fake_clouds], axis=0)) # [2B], [2B,N]
+            real_shape_score, fake_shape_score = tf.split(shape_score, 2, axis=0)
+            real_per_point_score, fake_per_point_score = tf.split(per_point_score, 2, axis=0)
+            return real_shape_score, real_per_point_score, fake_shape_score, fake_per_point_score
+        return (*D(real_clouds), *D(fake_clouds))
+
+    def train_d(real_clouds, fake_clouds):
+        # train D with real and fake clouds
+        with tf.GradientTape() as tape:
+            real_shape_score, real_per_point_score, fake_shape_score, fake_per_point_score = score(real_clouds, fake_clouds)
+            # print("real score: ", real_shape_score)
+            # print("fake score: ", fake_shape_score)
+            d_loss = D.loss(real_shape_score, real_per_point_score, fake_shape_score, fake_per_point_score)
+            scaled_d_loss = scale_loss(d_loss, d_optimizer)
+        apply_gradients(tape, scaled_d_loss, D, d_optimizer)
+        return d_loss
+
+    def replica_step(real_clouds):
+        """
+        trains D and G successively for one batch
+        
+        real_clouds: [B, N, 3]
+        returns: d_loss (scalar), g_loss (scalar), generated_clouds [B,N,3]
+        """
+        noise = sample_noise()
+        spheres = tf.repeat(tf.expand_dims(sphere, axis=0), batch_sz, axis=0) #[B,N,3]
+
+        if reuse_generator_forward:
+            with tf.GradientTape() as g_tape:
+                # generate fake images once, keep the G activations for the G update
+                fake_clouds = G(spheres, noise)
+                with g_tape.stop_recording():
+                    d_loss = train_d(real_clouds, tf.stop_gradient(fake_clouds))
+                # train G with the same fake clouds, scored by the updated D
+                fake_shape_score, fake_per_point_score = D(fake_clouds)
+                g_loss = G.loss(fake_shape_score, fake_per_point_score)
+                scaled_g_loss = scale_loss(g_loss, g_optimizer)
+            apply_gradients(g_tape, scaled_g_loss, G, g_optimizer)
+            return d_loss, g_loss, fake_clouds
+
+        # generate fake images
+        fake_clouds = G(spheres, noise)
+        d_loss = train_d(real_clouds, fake_clouds)
+
+        noise = sample_noise()
+        # train G with fake clouds
+        with tf.GradientTape() as tape:
+            fake_shape_score, fake_per_point_score = D(G(spheres, noise))
+            g_loss = G.loss(fake_shape_score, fake_per_point_score)
+            scaled_g_loss = scale_loss(g_loss, g_optimizer)
+        apply_gradients(tape, scaled_g_loss, G, g_optimizer)
         
-            # plot losses dynamically
-            pyplot.cla()
-            pyplot.plot(G_losses, label='generator')
-            pyplot.plot(D_losses, label='discriminator')
-            pyplot.xlabel("batch")
-            pyplot.ylabel("loss")
-            pyplot.legend()
-            pyplot.title("G vs. D losses per epoch")
-            pyplot.pause(0.05) #update plot
-
-        # occasionally display generator output
-        # if batch_num % 100 == 99:
-        #     generated_clouds = tf.make_tensor_proto(generated_clouds)
-        #     generated_clouds = trimesh.points.PointCloud(tf.make_ndarray(generated_clouds)[0])
-        #     generated_clouds.show()
-    if epoch % 3 == 2:
-        print("saving")
-        path = checkpoint.save(checkpoint_dir_prefix)
-        print("path:", path)
-
-G.summary()
-pyplot.show()
+        return d_loss, g_loss, fake_clouds
+
+    @tf.function(jit_compile=jit_compile)
+    def train_batch(real_clouds):
+        """
+        real_clouds: [B * replicas, N, 3] (distributed)
+        returns: d_loss, g_loss averaged over the replicas, the first local replica's generated_clouds [B,N,3]
+        """
+        d_loss, g_loss, fake_clouds = strategy.run(replica_step, args=(real_clouds,))
+        d_loss = strategy.reduce(tf.distribute.ReduceOp.MEAN, d_loss, axis=None)
+        g_loss = strategy.reduce(tf.distribute.ReduceOp.MEAN, g_loss, axis=None)
+        return d_loss, g_loss, strategy.experimental_local_results(fake_clouds)[0]
+
+    return train_batch
+
+
+if __name__ == "__main__":
+    strategy = make_strategy(distribution, num_cpu_replicas)
+    # every replica trains on batch_sz clouds
+    global_batch_sz = batch_sz * strategy.num_replicas_in_sync
+    if fast_training:
+        # compute in reduced precision, keep variables (and the tanh/sigmoid outputs, norms, kNN) in float32
+        keras.mixed_precision.set_global_policy(mixed_precision_policy)
+
+    # ====== DATA PREPROCESSING ========
+    if resample_every_epoch:
+        # fresh surface samples every epoch, drawn from the cached triangles of each mesh
+        triangle_tables = load_triangle_tables(mesh_paths(num_examples))
+    else:
+        # read in meshes and convert to point clouds (sampled in parallel once, then memory-mapped from ./dataset_cache)
+        data = load_point_clouds(mesh_paths(num_examples), num_points, seed=data_seed) #[num_examples, N, 3]
+
+        # stream the examples by index from the memory-mapped cache (from_tensor_slices would copy it into the graph)
+        dataset = tf.data.Dataset.range(len(data)).map(lambda i: tf.numpy_function(lambda j: data[j], [i], tf.float32))
+        dataset = dataset.map(lambda cloud: tf.ensure_shape(cloud, [num_points, 3]))
+
+
+    def make_dataset(epoch, skip=0):
+        """
+        returns: the batched real clouds for this epoch, [B, N, 3] for each replica
+        skip: global steps of the epoch already trained (resuming), every epoch is rebuilt in the same order
+        """
+        def replica_dataset(input_context):
+            # each input pipeline (worker) reads a disjoint slice of the examples
+            num_shards, shard_index = input_context.num_input_pipelines, input_context.input_pipeline_id
+            if resample_every_epoch:
+                replica_batches = make_resampling_dataset(triangle_tables, num_points, batch_sz, data_seed, epoch, num_shards, shard_index)
+            else:
+                replica_batches = dataset.shard(num_shards, shard_index).shuffle(buffer_size=num_examples, seed=data_seed + epoch)
+                replica_batches = replica_batches.batch(batch_sz, drop_remainder=True)
+            # skip counts global steps, each step takes one batch per replica fed by this pipeline
+            replicas_per_pipeline = strategy.num_replicas_in_sync // input_context.num_input_pipelines
+            return replica_batches.skip(skip * replicas_per_pipeline)
+        return strategy.distribute_datasets_from_function(replica_dataset)
+
+    # read in FIXED sphere points and its (cached) kNN graph
+    sphere = load_sphere(num_points) #[N,3]
+    sphere_nn_idx = sphere_knn(num_points) #[N,k]
+    if eval_every:
+        eval_reference = load_point_clouds(mesh_paths(num_examples), num_points, seed=data_seed)[:eval_samples]
+
+
+    # ====== MAIN LOOP ==========
+    with strategy.scope():
+        D = Discriminator(num_points, per_point_loss_weight)
+        G = Generator(num_points, latent_dim, per_point_loss_weight, sphere_nn_idx=sphere_nn_idx, knn_memory_budget=knn_memory_budget)
+        d_optimizer = keras.optimizers.Adam(learning_rate_d, beta_1=0.5)
+        g_optimizer = keras.optimizers.Adam(learning_rate_g, beta_1=0.5)
+        if fast_training:
+            d_optimizer = keras.mixed_precision.LossScaleOptimizer(d_optimizer)
+            g_optimizer = keras.mixed_precision.LossScaleOptimizer(g_optimizer)
+        rng = tf.random.Generator.from_seed(train_seed)
+    train_batch = make_train_batch(G, D, g_optimizer, d_optimizer, sphere, batch_sz, latent_dim, jit_compile=fast_training,
+                                   fuse_discriminator=fuse_discriminator, reuse_generator_forward=reuse_generator_forward,
+                                   strategy=strategy, rng=rng)
+    # full training state, every worker saves (the save is collective), only the chief's files are the real ones
+    checkpoint = TrainingCheckpoint(task_dir(checkpoint_dir, strategy), keep_checkpoints, best_metric, async_checkpoints,
+                                    G=G, D=D, g_optimizer=g_optimizer, d_optimizer=d_optimizer, rng=rng)
+    start_epoch, start_batch, step = checkpoint.restore()
+    # losses are averaged on device and written by a background thread, never read back in the loop
+    metrics = MetricsLogger(task_dir(log_dir, strategy))
+
+    for epoch in range(start_epoch, epochs):
+        print("================ Epoch: ", epoch)
+        window_start = time.perf_counter()
+        skip = start_batch if epoch == start_epoch else 0
+        epoch_sums, epoch_batches = {}, 0 # for best_metric, read back once per epoch
+        for batch_num, real_cloud_batch in enumerate(make_dataset(epoch, skip), start=skip):
+            d_loss, g_loss, generated_clouds = train_batch(real_cloud_batch)
+            metrics.accumulate(d_loss=d_loss, g_loss=g_loss)
+            epoch_sums = {"d_loss": epoch_sums.get("d_loss", 0) + d_loss, "g_loss": epoch_sums.get("g_loss", 0) + g_loss}
+            epoch_batches += 1
+            step += 1
+
+            if step % checkpoint_every == 0:
+                checkpoint.save(epoch, batch_num + 1, step)
+
+            if step % log_every == 0:
+                elapsed = time.perf_counter() - window_start
+                window_start = time.perf_counter()
+                metrics.log_accumulated(step, epoch=epoch, step_seconds=elapsed/log_every, examples_per_sec=log_every*global_batch_sz/elapsed)
 
+            # occasionally display generator output
+            # if batch_num % 100 == 99:
+            #     generated_clouds = tf.make_tensor_proto(generated_clouds)
+            #     generated_clouds = trimesh.points.PointCloud(tf.make_ndarray(generated_clouds)[0])
+            #     generated_clouds.show()
+        epoch_values = {name: float(total) / epoch_batches for name, total in epoch_sums.items()}
+        if eval_every and (epoch + 1) % eval_every == 0:
+            # deterministic (fixed latents and reference), so every worker gets the same result
+            results = evaluate(G.generate(sphere, eval_samples, seed=0), eval_reference, eval_metrics, eval_ann_k)
+            metrics.log(step, epoch=epoch, **results)
+            print("eval:", results)
+            epoch_values.update(results)
+        path = checkpoint.save(epoch + 1, 0, step)
+        print("saved", path)
+        if best_metric in epoch_values:
+            checkpoint.save_if_best(epoch + 1, 0, step, epoch_values[best_metric])
 
+    checkpoint.sync()
+    metrics.close()
+    G.summary()
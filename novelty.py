@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+# ====== NOVELTY INDEX ===========
+# Compact descriptors of every training cloud in a vector index, so a batch of generated clouds finds its nearest
+# training shapes in milliseconds instead of a Chamfer sweep over the whole dataset. Descriptors:
+#   d2             D2 shape distribution (Osada et al. 2002): sqrt histogram of distances between random point pairs,
+#                  unaffected by point order, rotation and translation (L2 between them ~ Hellinger distance)
+#   discriminator  the trained D's feature_extraction + max_pool features (needs a training checkpoint with D)
+# Novelty is the descriptor distance to the nearest training shape, near-copies score ~0. Descriptors of a cloud vary
+# with its random surface sample, so --rerank scores the top-k candidates by exact Chamfer distance instead: an N x N
+# distance sweep per candidate, ~2 s per 16 clouds at k=5, N=2048 on one CPU core against ~10 ms without it.
+# Adding clouds only describes the new ones.
+#   python novelty.py build --num_examples 960
+#   python novelty.py query --generated generated_bluenos --k 5 --rerank --out novelty.json
+
+
+# ====== DESCRIPTORS ==========
+def d2_descriptors(clouds, max_distance, bins=64, pairs=8192, seed=0):
+    """
+    clouds: [B, N, 3], max_distance: upper edge of the last bin (longer distances fall into it)
+    returns: [B, bins] (float32)
+    """
+    clouds = np.asarray(clouds, np.float32)
+    rng = np.random.default_rng(seed)
+    a, b = rng.integers(clouds.shape[1], size=(2, pairs))
+    distances = np.linalg.norm(clouds[:, a] - clouds[:, b], axis=-1) # [B, pairs]
+    bin_idx = np.minimum((distances / max_distance * bins).astype(np.int64), bins - 1)
+    bin_idx += np.arange(len(clouds))[:, None] * bins
+    counts = np.bincount(bin_idx.ravel(), minlength=len(clouds) * bins).reshape([len(clouds), bins])
+    return np.sqrt(counts / pairs).astype(np.float32)
+
+
+def discriminator_descriptors(D, clouds, max_batch=64):
+    """returns: [B, 512] unit length max-pooled D features (float32)"""
+    features = []
+    for i in range(0, len(clouds), max_batch):
+        pooled = D.max_pool(D.feature_extraction(tf.constant(clouds[i:i+max_batch], tf.float32)))
+        features.append(tf.math.l2_normalize(tf.cast(pooled, tf.float32), axis=-1).numpy())
+    return np.concatenate(features)
+
+
+def load_discriminator(checkpoint_dir, num_points):
+    """D restored from a main.py training checkpoint"""
+    from discriminator import Discriminator
+    from main import per_point_loss_weight
+    D = Discriminator(num_points, per_point_loss_weight)
+    D(tf.zeros([1, num_points, 3]))
+    path = tf.train.latest_checkpoint(checkpoint_dir)
+    print("loading discriminator from " + path)
+    tf.train.Checkpoint(D=D).restore(path).expect_partial().assert_existing_objects_matched()
+    return D
+
+
+# ====== INDEX ==========
+class NoveltyIndex:
+    def __init__(self, descriptor="d2", max_distance=None, backend="auto", D=None):
+        """
+        descriptor: "d2" or "discriminator" (then D: the trained Discriminator)
+        max_distance: D2 histogram range, default: 1.25 * the largest bounding box diagonal of the first clouds added
+        backend: "faiss" (flat L2 index, if installed), "exact" (numpy) or "auto"
+        """
+        if descriptor == "discriminator" and D is None:
+            raise ValueError("the discriminator descriptor needs D")
+        if backend == "auto":
+            try:
+                import faiss
+                backend = "faiss"
+            except ImportError:
+                backend = "exact"
+        self.descriptor = descriptor
+        self.max_distance = max_distance
+        self.backend = backend
+        self.D = D
+        self.vectors = None # [M, dim]
+        self.search = None # faiss index over self.vectors
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def describe(self, clouds):
+        """clouds: [B, N, 3], returns: [B, dim] descriptors"""
+        if self.descriptor == "discriminator":
+            return discriminator_descriptors(self.D, clouds)
+        if self.max_distance is None:
+            extent = np.max(clouds, axis=1) - np.min(clouds, axis=1) # [B, 3]
+            self.max_distance = 1.25 * float(np.max(np.linalg.norm(extent, axis=-1)))
+        return d2_descriptors(clouds, self.max_distance)
+
+    def add(self, clouds, max_batch=1024):
+        """appends clouds [B, N, 3] (numpy or memory-mapped), they get the next ids len(self)..len(self)+B-1"""
+        vectors = np.concatenate([self.describe(clouds[i:i+max_batch]) for i in range(0, len(clouds), max_batch)])
+        self.add_vectors(vectors)
+
+    def add_vectors(self, vectors):
+        self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+        if self.backend == "faiss":
+            import faiss
+            if self.search is None:
+                self.search = faiss.IndexFlatL2(vectors.shape[1])
+            self.search.add(np.ascontiguousarray(vectors))
+
+    def nearest(self, vectors, k):
+        """returns: squared descriptor distances [Q, k] (ascending), ids [Q, k]"""
+        k = min(k, len(self))
+        if self.backend == "faiss":
+            return self.search.search(np.ascontiguousarray(vectors), k)
+        dist = np.maximum(np.sum(vectors**2, axis=1)[:, None] - 2 * vectors @ self.vectors.T
+                          + np.sum(self.vectors**2, axis=1)[None, :], 0) # [Q, M]
+        ids = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        dist = np.take_along_axis(dist, ids, axis=1)
+        order = np.argsort(dist, axis=1)
+        return np.take_along_axis(dist, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def query(self, clouds, k=5, reference=None, memory_budget=256*2**20):
+        """
+        clouds: [Q, N, 3] generated clouds
+        reference: optional training clouds [M, N, 3] (in id order) to rank the k candidates by exact Chamfer distance,
+                   Q * k full N x N distance computations
+        returns: novelty scores [Q] (distance to the nearest training shape), distances [Q, k] (ascending), ids [Q, k]
+        """
+        dist, ids = self.nearest(self.describe(clouds), k)
+        dist = np.sqrt(dist)
+        if reference is not None:
+            from evaluation import pair_distances
+            rows = np.repeat(np.arange(len(clouds)), ids.shape[1])
+            dist = pair_distances(clouds, reference, rows, ids.ravel(), "cd", memory_budget).reshape(ids.shape)
+            order = np.argsort(dist, axis=1)
+            dist, ids = np.take_along_axis(dist, order, axis=1), np.take_along_axis(ids, order, axis=1)
+        return dist[:, 0], dist, ids
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "descriptors.npy"), self.vectors)
+        with open(os.path.join(directory, "index.json"), "w") as f:
+            json.dump({"descriptor": self.descriptor, "max_distance": self.max_distance, "size": len(self)}, f)
+
+    @classmethod
+    def load(cls, directory, backend="auto", D=None):
+        with open(os.path.join(directory, "index.json")) as f:
+            config = json.load(f)
+        index = cls(config["descriptor"], config["max_distance"], backend, D)
+        index.add_vectors(np.load(os.path.join(directory, "descriptors.npy")))
+        return index
+
+
+def load_generated(path, limit=None):
+    """path: a .npy of clouds [M, N, 3] or a bulk_generate.py output directory"""
+    if not os.path.isdir(path):
+        return np.asarray(np.load(path, mmap_mode="r")[:limit], np.float32)
+    from bulk_generate import complete_shards
+    clouds, count = [], 0
+    for shard, _, _ in complete_shards(path): # memmaps, only the clouds kept are read
+        clouds.append(np.asarray(shard[:None if limit is None else limit - count], np.float32))
+        count += len(clouds[-1])
+        if limit is not None and count >= limit:
+            break
+    return np.concatenate(clouds)
+
+
+if __name__ == "__main__":
+    from preprocess import load_point_clouds, mesh_paths
+    parser = argparse.ArgumentParser(description="nearest training shapes + novelty of generated Bluenos")
+    parser.add_argument("mode", choices=["build", "query"])
+    parser.add_argument("--index_dir", default="novelty_index")
+    parser.add_argument("--num_examples", type=int, default=960, help="training clouds to index, only new ones are added")
+    parser.add_argument("--num_points", type=int, default=2048)
+    parser.add_argument("--seed", type=int, default=0, help="point cloud cache seed")
+    parser.add_argument("--descriptor", default="d2", choices=["d2", "discriminator"])
+    parser.add_argument("--checkpoint_dir", default="training_checkpoints2", help="for the discriminator descriptor")
+    parser.add_argument("--backend", default="auto", choices=["auto", "faiss", "exact"])
+    parser.add_argument("--generated", default=None, help=".npy or bulk_generate.py directory, default: sample the checkpoint")
+    parser.add_argument("--num_generated", type=int, default=256)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--rerank", action="store_true", help="score the k candidates by exact Chamfer distance (slow)")
+    parser.add_argument("--out", default=None, help="write the scores, distances and ids as JSON")
+    args = parser.parse_args()
+
+    D = None
+    if os.path.exists(os.path.join(args.index_dir, "index.json")):
+        with open(os.path.join(args.index_dir, "index.json")) as f:
+            args.descriptor = json.load(f)["descriptor"]
+    if args.descriptor == "discriminator":
+        D = load_discriminator(args.checkpoint_dir, args.num_points)
+    if os.path.exists(os.path.join(args.index_dir, "index.json")):
+        index = NoveltyIndex.load(args.index_dir, args.backend, D)
+    else:
+        index = NoveltyIndex(args.descriptor, backend=args.backend, D=D)
+
+    if args.mode == "build":
+        if args.num_examples > len(index):
+            print("indexing clouds %d..%d" % (len(index), args.num_examples - 1))
+            index.add(load_point_clouds(mesh_paths(args.num_examples), args.num_points, seed=args.seed)[len(index):])
+            index.save(args.index_dir)
+        print("%d clouds indexed in %s" % (len(index), args.index_dir))
+    else:
+        if args.generated:
+            generated = load_generated(args.generated, args.num_generated)
+        else:
+            from inference import load_generator
+            G, sphere = load_generator()
+            generated = G.generate(sphere, args.num_generated, seed=args.seed)
+        reference = load_point_clouds(mesh_paths(len(index)), args.num_points, seed=args.seed) if args.rerank else None
+        scores, distances, ids = index.query(generated, args.k, reference)
+        print("novelty  min %.6f  median %.6f  max %.6f" % (np.min(scores), np.median(scores), np.max(scores)))
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump({"novelty": scores.tolist(), "distances": distances.tolist(), "ids": ids.tolist()}, f)
@@ -0,0 +1,155 @@
+import argparse
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+from discriminator import Discriminator
+from generator import Generator
+from sphere import load_sphere, sphere_knn
+from main import make_train_batch, batch_sz, latent_dim, learning_rate_d, learning_rate_g, num_points, per_point_loss_weight
+
+# ====== MIXED PRECISION / XLA PARITY + THROUGHPUT CHECK ===========
+# Runs the fast-training path (mixed precision + jit_compile) against the float32 path on the same weights and inputs:
+# the forward outputs, losses and gradients, then one compiled make_train_batch step each (its losses and weight
+# updates), must agree within tolerance (exit code 1 otherwise), then both train steps are timed.
+#   python precision_check.py --policy mixed_bfloat16
+
+
+def build_models(policy, spheres, noise):
+    num_points = spheres.shape[1]
+    keras.mixed_precision.set_global_policy(policy)
+    G = Generator(num_points, latent_dim, per_point_loss_weight, sphere_nn_idx=sphere_knn(num_points))
+    D = Discriminator(num_points, per_point_loss_weight)
+    D(G(spheres, noise)) # build
+    keras.mixed_precision.set_global_policy("float32")
+    return G, D
+
+
+def losses_and_grads(G, D, spheres, noise, real_clouds, loss_scale=1.0):
+    """loss_scale: static stand-in for LossScaleOptimizer so small reduced precision gradients don't underflow"""
+    with tf.GradientTape(persistent=True) as tape:
+        fake_clouds = G(spheres, noise)
+        real_shape_score, real_per_point_score = D(real_clouds)
+        fake_shape_score, fake_per_point_score = D(fake_clouds)
+        d_loss = D.loss(real_shape_score, real_per_point_score, fake_shape_score, fake_per_point_score)
+        g_loss = G.loss(fake_shape_score, fake_per_point_score)
+        scaled_d_loss, scaled_g_loss = d_loss * loss_scale, g_loss * loss_scale
+    d_grads = [grad / loss_scale for grad in tape.gradient(scaled_d_loss, D.trainable_variables)]
+    g_grads = [grad / loss_scale for grad in tape.gradient(scaled_g_loss, G.trainable_variables)]
+    return fake_clouds, d_loss, g_loss, d_grads, g_grads
+
+
+def cosine(grads_a, grads_b):
+    a = tf.concat([tf.reshape(tf.cast(g, tf.float32), [-1]) for g in grads_a], 0)
+    b = tf.concat([tf.reshape(tf.cast(g, tf.float32), [-1]) for g in grads_b], 0)
+    return float(tf.reduce_sum(a*b) / (tf.norm(a) * tf.norm(b)))
+
+
+def make_optimizers(mixed):
+    """returns: (g_optimizer, d_optimizer), loss scaled under mixed precision as in main.py"""
+    optimizers = [keras.optimizers.Adam(lr, beta_1=0.5) for lr in (learning_rate_g, learning_rate_d)]
+    if mixed:
+        optimizers = [keras.mixed_precision.LossScaleOptimizer(optimizer) for optimizer in optimizers]
+    return optimizers
+
+
+def compiled_step_parity(models32, models16, sphere, batch_sz, real_clouds):
+    """
+    one make_train_batch step each: float32 without XLA vs the mixed precision models XLA compiled with loss scaling,
+    from identical weights and latent noise
+    returns: {d/g_step_loss_rel_diff, d/g_update_cosine (of the weight changes)}, the weights are restored after
+    """
+    report = {}
+    before = [model.get_weights() for model in models32]
+    updates = []
+    for (G, D), mixed in [(models32, False), (models16, True)]:
+        rng = tf.random.Generator.from_seed(0) # same latent noise for both steps
+        train_batch = make_train_batch(G, D, *make_optimizers(mixed), sphere, batch_sz, latent_dim, jit_compile=mixed, rng=rng)
+        d_loss, g_loss, _ = train_batch(real_clouds)
+        updates.append(([after - start for after, start in zip(G.get_weights(), before[0])],
+                        [after - start for after, start in zip(D.get_weights(), before[1])], float(d_loss), float(g_loss)))
+        G.set_weights(before[0])
+        D.set_weights(before[1])
+    (g32, d32, d_loss32, g_loss32), (g16, d16, d_loss16, g_loss16) = updates
+    report["d_step_loss_rel_diff"] = abs(d_loss16 - d_loss32) / abs(d_loss32)
+    report["g_step_loss_rel_diff"] = abs(g_loss16 - g_loss32) / abs(g_loss32)
+    report["d_update_cosine"] = cosine(d32, d16)
+    report["g_update_cosine"] = cosine(g32, g16)
+    return report
+
+
+def time_steps(train_batch, real_clouds, steps):
+    """returns: (first call i.e. trace/compile seconds, mean seconds per step after that)"""
+    start = time.perf_counter()
+    train_batch(real_clouds)[0].numpy()
+    compile_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(steps):
+        d_loss = train_batch(real_clouds)[0]
+    d_loss.numpy()
+    return compile_seconds, (time.perf_counter() - start) / steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the mixed precision + XLA train step against float32")
+    parser.add_argument("--policy", default="mixed_float16", choices=["mixed_float16", "mixed_bfloat16"])
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--batch_sz", type=int, default=batch_sz)
+    parser.add_argument("--num_points", type=int, default=num_points)
+    parser.add_argument("--atol", type=float, default=5e-2, help="max abs difference of generated clouds")
+    parser.add_argument("--rtol", type=float, default=5e-2, help="max relative difference of the losses")
+    parser.add_argument("--min_cosine", type=float, default=None, help="min cosine similarity of the gradients (default per policy)")
+    parser.add_argument("--min_update_cosine", type=float, default=None, help="min cosine similarity of one train step's weight updates (default per policy)")
+    args = parser.parse_args()
+    if args.min_cosine is None:
+        # bfloat16 keeps 8 mantissa bits against float16's 11, its gradients drift further
+        args.min_cosine = {"mixed_float16": 0.98, "mixed_bfloat16": 0.85}[args.policy]
+    if args.min_update_cosine is None:
+        # Adam's first step moves every weight by ~lr * sign(grad): the sign flips of near-zero gradients count as much
+        # as large gradients, so the updates agree less than the gradients do
+        args.min_update_cosine = {"mixed_float16": 0.8, "mixed_bfloat16": 0.7}[args.policy]
+
+    sphere = load_sphere(args.num_points)
+    spheres = tf.repeat(tf.expand_dims(sphere, axis=0), args.batch_sz, axis=0) #[B,N,3]
+    noise = tf.random.normal([args.batch_sz, latent_dim])
+    real_clouds = tf.random.uniform([args.batch_sz, args.num_points, 3], -1, 1)
+
+    G32, D32 = build_models("float32", spheres, noise)
+    G16, D16 = build_models(args.policy, spheres, noise)
+    G16.set_weights(G32.get_weights())
+    D16.set_weights(D32.get_weights())
+
+    # ====== PARITY ==========
+    clouds32, d_loss32, g_loss32, d_grads32, g_grads32 = losses_and_grads(G32, D32, spheres, noise, real_clouds)
+    clouds16, d_loss16, g_loss16, d_grads16, g_grads16 = losses_and_grads(G16, D16, spheres, noise, real_clouds, loss_scale=2.0**15)
+    report = {
+        "cloud_max_abs_diff": float(tf.reduce_max(tf.abs(clouds32 - clouds16))),
+        "d_loss_rel_diff": abs(float(d_loss16) - float(d_loss32)) / abs(float(d_loss32)),
+        "g_loss_rel_diff": abs(float(g_loss16) - float(g_loss32)) / abs(float(g_loss32)),
+        "d_grad_cosine": cosine(d_grads32, d_grads16),
+        "g_grad_cosine": cosine(g_grads32, g_grads16),
+    }
+    for name, value in report.items():
+        print("%-20s %.6f" % (name, value))
+    # the step that ships: make_train_batch under the policy, XLA compiled, with the loss scale optimizer
+    step_report = compiled_step_parity((G32, D32), (G16, D16), sphere, args.batch_sz, real_clouds)
+    for name, value in step_report.items():
+        print("%-20s %.6f" % (name, value))
+    passed = (np.all(np.isfinite(list(report.values()) + list(step_report.values())))
+        and report["cloud_max_abs_diff"] <= args.atol
+        and max(report["d_loss_rel_diff"], report["g_loss_rel_diff"]) <= args.rtol
+        and min(report["d_grad_cosine"], report["g_grad_cosine"]) >= args.min_cosine
+        and max(step_report["d_step_loss_rel_diff"], step_report["g_step_loss_rel_diff"]) <= args.rtol
+        and min(step_report["d_update_cosine"], step_report["g_update_cosine"]) >= args.min_update_cosine)
+    print("parity:", "PASSED" if passed else "FAILED")
+
+    # ====== THROUGHPUT ==========
+    for name, G, D, (g_optimizer, d_optimizer), jit_compile in [
+            ("float32", G32, D32, make_optimizers(False), False),
+            (args.policy + " + XLA", G16, D16, make_optimizers(True), True)]:
+        train_batch = make_train_batch(G, D, g_optimizer, d_optimizer, sphere, args.batch_sz, latent_dim, jit_compile=jit_compile)
+        compile_seconds, step_seconds = time_steps(train_batch, real_clouds, args.steps)
+        print("%-28s compile %6.1fs  step %7.1fms  %6.1f examples/sec" % (name, compile_seconds, 1000*step_seconds, args.batch_sz/step_seconds))
+
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tensorflow as tf
+import trimesh
+
+# ====== MESH -> POINT CLOUD PREPROCESSING ===========
+# Sampling the STL meshes is done once in a process pool and written to a single memory-mapped .npy
+# [num_examples, num_points, 3] keyed by (mesh file hashes, num_points, seed). Later runs map the cache.
+# For per-epoch resampling the raw triangles are cached instead (TriangleTables) and sampled on the fly.
+cache_dir = "./dataset_cache"
+
+
+def mesh_paths(num_examples, mesh_dir="./blueno"):
+    return [os.path.join(mesh_dir, "blueno" + str(i) + ".stl") for i in range(num_examples)]
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_key(paths, *params):
+    key = hashlib.sha1()
+    for path in paths:
+        key.update(file_hash(path).encode())
+    key.update(repr(params).encode())
+    return key.hexdigest()[:16]
+
+
+def triangle_table(mesh):
+    """
+    mesh: trimesh.Trimesh
+    returns: triangle corners [F, 3, 3] (float32)
+    """
+    return np.asarray(mesh.triangles, dtype=np.float32)
+
+
+def cumulative_areas(triangles):
+    """triangles: [F, 3, 3], returns running sum of (twice) the face areas [F]"""
+    edge1 = triangles[:, 1] - triangles[:, 0]
+    edge2 = triangles[:, 2] - triangles[:, 0]
+    return np.cumsum(np.linalg.norm(np.cross(edge1, edge2), axis=-1), dtype=np.float64)
+
+
+def sample_surface(triangles, num_points, rng, cum_areas=None):
+    """
+    Uniform (area-weighted) random points on a triangle soup, vectorized over all samples.
+    triangles: [F, 3, 3]
+    rng: np.random.Generator
+    cum_areas: precomputed cumulative_areas(triangles), optional
+    returns: [num_points, 3] (float32)
+    """
+    if cum_areas is None:
+        cum_areas = cumulative_areas(triangles)
+    face = np.searchsorted(cum_areas, rng.random(num_points) * cum_areas[-1])
+    face = np.minimum(face, len(triangles) - 1)
+    corners = triangles[face] # [num_points, 3, 3]
+
+    # random barycentric coords, reflected back into the triangle when u+v > 1
+    u, v = rng.random((2, num_points, 1), dtype=np.float32)
+    outside = (u + v) > 1
+    u, v = np.where(outside, 1 - u, u), np.where(outside, 1 - v, v)
+    return corners[:, 0] + u * (corners[:, 1] - corners[:, 0]) + v * (corners[:, 2] - corners[:, 0])
+
+
+def load_triangles(path):
+    """worker: load one mesh, returns [F, 3, 3]"""
+    return triangle_table(trimesh.load(path))
+
+
+def sample_mesh(args):
+    """worker: load one mesh and sample it with its own seed, returns [N, 3]"""
+    path, num_points, seed, i = args
+    mesh = trimesh.load(path)
+    return sample_surface(triangle_table(mesh), num_points, np.random.default_rng([seed, i]))
+
+
+def build_point_cloud_cache(paths, num_points, seed, out_path, workers=None):
+    """samples every mesh across a process pool straight into a .npy memmap at out_path"""
+    tmp_path = out_path + ".tmp.npy"
+    data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(paths), num_points, 3))
+    jobs = [(path, num_points, seed, i) for i, path in enumerate(paths)]
+    with ProcessPoolExecutor(workers) as pool:
+        for i, cloud in enumerate(pool.map(sample_mesh, jobs, chunksize=8)):
+            data[i] = cloud
+    data.flush()
+    del data
+    os.replace(tmp_path, out_path)
+
+
+def point_cloud_cache_path(paths, num_points, seed=0):
+    """where load_point_clouds keeps (or looks for) the sampled clouds of these meshes"""
+    return os.path.join(cache_dir, "clouds_" + str(num_points) + "_" + cache_key(paths, num_points, seed) + ".npy")
+
+
+def write_cache_metadata(out_path, paths, num_points, seed):
+    with open(os.path.splitext(out_path)[0] + ".json", "w") as f:
+        json.dump({"paths": paths, "num_points": num_points, "seed": seed}, f)
+
+
+def load_point_clouds(paths, num_points, seed=0, workers=None):
+    """
+    returns: memory-mapped point clouds [len(paths), num_points, 3] (float32), built on the first call
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    out_path = point_cloud_cache_path(paths, num_points, seed)
+    if not os.path.exists(out_path):
+        print("sampling", len(paths), "meshes into", out_path)
+        build_point_cloud_cache(paths, num_points, seed, out_path, workers)
+        write_cache_metadata(out_path, paths, num_points, seed)
+    return np.load(out_path, mmap_mode="r")
+
+
+class TriangleTables:
+    """
+    Triangles of every mesh concatenated into one memory-mapped [total_F, 3, 3] array with per-mesh face offsets and
+    cumulative areas, so a fresh cloud can be drawn from any mesh without touching the STL files again.
+    """
+    def __init__(self, triangles, cum_areas, offsets):
+        self.triangles = triangles # [total_F, 3, 3]
+        self.cum_areas = cum_areas # [total_F], restarts at every mesh
+        self.offsets = offsets # [num_examples+1]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sample(self, i, num_points, rng):
+        """returns: fresh surface samples of mesh i [num_points, 3]"""
+        lo, hi = self.offsets[i], self.offsets[i+1]
+        return sample_surface(self.triangles[lo:hi], num_points, rng, self.cum_areas[lo:hi])
+
+
+triangle_table_names = ["triangles", "cum_areas", "offsets"]
+
+
+def triangle_tables_prefix(paths):
+    """where load_triangle_tables keeps (or looks for) the triangle tables of these meshes"""
+    return os.path.join(cache_dir, "triangles_" + cache_key(paths))
+
+
+def save_triangle_tables(prefix, tables):
+    """tables: per-mesh [F, 3, 3] arrays (may be memory-mapped), concatenated straight into the .npy files"""
+    offsets = np.cumsum([0] + [len(t) for t in tables])
+    triangles = np.lib.format.open_memmap(prefix + "_triangles.npy", mode="w+", dtype=np.float32, shape=(offsets[-1], 3, 3))
+    cum_areas = np.lib.format.open_memmap(prefix + "_cum_areas.npy", mode="w+", dtype=np.float64, shape=(offsets[-1],))
+    for i, table in enumerate(tables):
+        triangles[offsets[i]:offsets[i+1]] = table
+        cum_areas[offsets[i]:offsets[i+1]] = cumulative_areas(np.asarray(table))
+    triangles.flush()
+    cum_areas.flush()
+    del triangles, cum_areas
+    np.save(prefix + "_offsets.npy", offsets) # offsets last: its presence marks a complete cache
+
+
+def load_triangle_tables(paths, workers=None):
+    """returns: TriangleTables of the meshes at paths, parsed across a process pool on the first call"""
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = triangle_tables_prefix(paths)
+    if not os.path.exists(prefix + "_offsets.npy"):
+        print("building triangle tables for", len(paths), "meshes")
+        with ProcessPoolExecutor(workers) as pool:
+            tables = list(pool.map(load_triangles, paths, chunksize=8))
+        save_triangle_tables(prefix, tables)
+    return TriangleTables(*[np.load(prefix + "_" + name + ".npy", mmap_mode="r") for name in triangle_table_names])
+
+
+def make_resampling_dataset(tables, num_points, batch_sz, seed, epoch, num_shards=1, shard_index=0):
+    """
+    Streaming input pipeline that draws new surface points for every example each epoch.
+    Shuffling and sampling are seeded by (seed, epoch, example) so any epoch can be rebuilt exactly.
+    num_shards/shard_index: every worker shuffles the same way and keeps a disjoint slice of the epoch
+    returns: tf.data.Dataset of [B, num_points, 3] batches
+    """
+    def sample(i):
+        return tables.sample(i, num_points, np.random.default_rng([seed, epoch, int(i)]))
+
+    dataset = tf.data.Dataset.range(len(tables))
+    dataset = dataset.shuffle(buffer_size=len(tables), seed=seed + epoch)
+    dataset = dataset.shard(num_shards, shard_index)
+    dataset = dataset.map(lambda i: tf.numpy_function(sample, [i], tf.float32), num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(lambda cloud: tf.ensure_shape(cloud, [num_points, 3]))
+    return dataset.batch(batch_sz, drop_remainder=True).prefetch(tf.data.AUTOTUNE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sample the Blueno meshes into the point cloud cache")
+    parser.add_argument("--num_examples", type=int, default=960)
+    parser.add_argument("--num_points", type=int, default=2048)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--triangles", action="store_true", help="also build the triangle tables for resampling")
+    args = parser.parse_args()
+    clouds = load_point_clouds(mesh_paths(args.num_examples), args.num_points, args.seed, args.workers)
+    print("cached clouds:", clouds.shape)
+    if args.triangles:
+        tables = load_triangle_tables(mesh_paths(args.num_examples), args.workers)
+        print("cached triangles:", tables.triangles.shape)
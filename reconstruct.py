@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import trimesh
+from scipy.spatial import cKDTree
+
+# ====== POINT CLOUD -> MESH RECONSTRUCTION ===========
+# Turns generated clouds into watertight meshes on the CPU, one cloud per worker process:
+#   normals  PCA of each point's k nearest neighbors (one kd-tree query + a batched eigendecomposition), oriented
+#            consistently along a minimum spanning tree of the same kNN graph
+#   surface  "hoppe": signed distance to the tangent planes of the nearest points (Hoppe et al. 1992) on a grid,
+#            meshed by marching cubes (scikit-image); "poisson": screened Poisson (open3d, if installed)
+# The largest connected piece is kept. Meshes are written as <out_dir>/blueno_<index>.<stl|ply>, and existing ones are
+# skipped, so an interrupted run resumes. A cloud that fails to mesh (e.g. a degenerate one) is logged and skipped.
+# Reads a .npy of clouds or a bulk_generate.py directory. With --follow it keeps picking up new shards while
+# bulk_generate.py is still writing them.
+#   python reconstruct.py --clouds generated_bluenos --out_dir meshes --follow --workers 8
+
+
+def estimate_normals(points, k=16, tree=None):
+    """
+    points: [N, 3], tree: cKDTree of points (built if None)
+    returns: unit normals [N, 3] pointing out of the surface, neighbor indices [N, k]
+    """
+    tree = tree or cKDTree(points)
+    nn_idx = tree.query(points, k)[1] # [N, k]
+    neighbors = points[nn_idx] - points[nn_idx].mean(axis=1, keepdims=True) # [N, k, 3]
+    covariance = np.einsum("nki,nkj->nij", neighbors, neighbors) # [N, 3, 3]
+    normals = np.linalg.eigh(covariance)[1][:, :, 0] # eigenvector of the smallest eigenvalue [N, 3]
+    return orient_normals(points, normals, nn_idx), nn_idx
+
+
+def orient_normals(points, normals, nn_idx):
+    """
+    consistent orientation (Hoppe et al. 1992): walk a minimum spanning tree of the kNN graph weighted by how far
+    neighboring normals are from parallel, starting from the topmost point whose normal points up
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import breadth_first_order, minimum_spanning_tree
+    rows = np.repeat(np.arange(len(points)), nn_idx.shape[1])
+    cols = nn_idx.ravel()
+    weights = 1 + 1e-6 - np.abs(np.sum(normals[rows] * normals[cols], axis=-1)) # > 0 so no edge disappears
+    graph = coo_matrix((weights, (rows, cols)), shape=(len(points),) * 2).tocsr()
+    tree = minimum_spanning_tree(graph.maximum(graph.T))
+
+    normals = normals.copy()
+    for component_root in unvisited_roots(points, tree):
+        if normals[component_root, 2] < 0:
+            normals[component_root] *= -1
+        order, parents = breadth_first_order(tree, component_root, directed=False)
+        for node in order[1:]: # parents come first
+            if np.dot(normals[node], normals[parents[node]]) < 0:
+                normals[node] *= -1
+    return normals
+
+
+def unvisited_roots(points, tree):
+    """yields the topmost point of every connected piece of the spanning forest"""
+    from scipy.sparse.csgraph import connected_components
+    labels = connected_components(tree, directed=False)[1]
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        yield members[np.argmax(points[members, 2])]
+
+
+def hoppe_signed_distance(points, normals, tree, resolution=64, padding=0.1, k=4):
+    """
+    returns: signed distances on a grid [R, R, R] (negative inside), grid origin [3], voxel size
+    """
+    low, high = points.min(axis=0), points.max(axis=0)
+    voxel = (1 + 2*padding) * np.max(high - low) / (resolution - 1)
+    origin = (low + high) / 2 - voxel * (resolution - 1) / 2
+    axis = np.arange(resolution)
+    grid = origin + voxel * np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape([-1, 3]) # [R^3, 3]
+
+    distances, nn_idx = tree.query(grid, k) # [R^3, k]
+    weights = 1 / (distances + 1e-9)
+    plane_distances = np.einsum("gkj,gkj->gk", grid[:, None] - points[nn_idx], normals[nn_idx]) # [R^3, k]
+    signed = (np.sum(weights * plane_distances, axis=1) / np.sum(weights, axis=1)).reshape([resolution] * 3)
+    # the padding is outside the shape: closes every surface that would otherwise run into the border
+    signed[[0, -1]] = signed[:, [0, -1]] = signed[:, :, [0, -1]] = voxel
+    return signed, origin, voxel
+
+
+def reconstruct(cloud, method="hoppe", resolution=64, k=16):
+    """
+    cloud: [N, 3]
+    returns: trimesh.Trimesh
+    """
+    points = np.asarray(cloud, np.float64)
+    tree = cKDTree(points)
+    normals, _ = estimate_normals(points, k, tree)
+    if method == "poisson":
+        import open3d
+        pcd = open3d.geometry.PointCloud(open3d.utility.Vector3dVector(points))
+        pcd.normals = open3d.utility.Vector3dVector(normals)
+        depth = int(np.log2(resolution))
+        o3d_mesh = open3d.geometry.TriangleMesh.create_from_point_cloud_poisson(pcd, depth=depth)[0]
+        mesh = trimesh.Trimesh(np.asarray(o3d_mesh.vertices), np.asarray(o3d_mesh.triangles))
+    elif method == "hoppe":
+        from skimage.measure import marching_cubes
+        signed, origin, voxel = hoppe_signed_distance(points, normals, tree, resolution)
+        vertices, faces = marching_cubes(signed, level=0, spacing=(voxel,) * 3)[:2]
+        mesh = trimesh.Trimesh(vertices + origin, faces)
+    else:
+        raise ValueError("unknown reconstruction method " + method)
+
+    pieces = mesh.split(only_watertight=False)
+    if len(pieces) > 1:
+        mesh = max(pieces, key=lambda piece: len(piece.faces)) # drops stray bits far from the surface
+    trimesh.repair.fix_normals(mesh)
+    return mesh
+
+
+def mesh_job(args):
+    """worker: reconstructs one cloud and writes it, returns (index, faces, watertight)"""
+    index, cloud, out_path, method, resolution, k = args
+    mesh = reconstruct(cloud, method, resolution, k)
+    tmp_path = out_path + ".tmp" + os.path.splitext(out_path)[1] # trimesh picks the format from the extension
+    mesh.export(tmp_path)
+    os.replace(tmp_path, out_path)
+    return index, len(mesh.faces), mesh.is_watertight
+
+
+def cloud_batches(path, follow=False, poll_seconds=5):
+    """
+    yields (first cloud index, clouds [B, N, 3]) from a .npy or, shard by shard, from a bulk_generate.py directory
+    follow: keep waiting for the shards bulk_generate.py has yet to write
+    """
+    if not os.path.isdir(path):
+        yield 0, np.load(path, mmap_mode="r")
+        return
+    from bulk_generate import complete_shards
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    total_shards = -(-manifest["num_clouds"] // manifest["shard_size"])
+    seen = set()
+    while True:
+        for clouds, _, info in complete_shards(path):
+            if info["shard"] not in seen:
+                seen.add(info["shard"])
+                yield info["first"], clouds
+        if not follow or len(seen) == total_shards:
+            return
+        time.sleep(poll_seconds)
+
+
+def count_finished(done, indices, counts):
+    """
+    done: finished mesh_job futures, indices: {future: cloud index}
+    adds them to counts {"written", "not_watertight", "failed"}, a failed cloud is logged and skipped
+    """
+    for future in done:
+        index = indices.pop(future)
+        try:
+            counts["not_watertight"] += not future.result()[2]
+            counts["written"] += 1
+        except Exception as e: # e.g. marching cubes finds no surface in the grid of a degenerate cloud
+            print("cloud %d failed: %s: %s" % (index, type(e).__name__, e))
+            counts["failed"] += 1
+
+
+def reconstruct_all(clouds_path, out_dir, method="hoppe", resolution=64, k=16, fmt="stl", workers=None,
+                    follow=False, limit=None):
+    """meshes every cloud without an output file yet across a process pool, returns the number of meshes written"""
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    counts = {"written": 0, "not_watertight": 0, "failed": 0}
+    with ProcessPoolExecutor(workers) as pool:
+        pending, indices = set(), {}
+        for first, clouds in cloud_batches(clouds_path, follow):
+            for offset in range(len(clouds)):
+                index = first + offset
+                if limit is not None and index >= limit:
+                    break
+                out_path = os.path.join(out_dir, "blueno_%07d.%s" % (index, fmt))
+                if os.path.exists(out_path):
+                    continue
+                if len(pending) >= 2 * workers: # bounds the clouds held in memory
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    count_finished(done, indices, counts)
+                future = pool.submit(mesh_job, (index, np.asarray(clouds[offset], np.float32), out_path, method, resolution, k))
+                pending.add(future)
+                indices[future] = index
+            print("%d meshes  %.2f meshes/sec" % (counts["written"], counts["written"] / (time.perf_counter() - start)))
+            if limit is not None and first + len(clouds) >= limit:
+                break
+        count_finished(wait(pending)[0], indices, counts)
+    if counts["not_watertight"]:
+        print("%d of %d meshes are not watertight" % (counts["not_watertight"], counts["written"]))
+    if counts["failed"]:
+        print("%d clouds failed and have no mesh, a rerun retries them" % counts["failed"])
+    return counts["written"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reconstruct meshes from generated point clouds")
+    parser.add_argument("--clouds", required=True, help=".npy of clouds [M, N, 3] or a bulk_generate.py directory")
+    parser.add_argument("--out_dir", default="generated_meshes")
+    parser.add_argument("--method", default="hoppe", choices=["hoppe", "poisson"])
+    parser.add_argument("--resolution", type=int, default=64, help="grid cells per side (poisson: 2^depth)")
+    parser.add_argument("--k", type=int, default=16, help="neighbors per normal estimate")
+    parser.add_argument("--format", default="stl", choices=["stl", "ply"])
+    parser.add_argument("--workers", type=int, default=None, help="default cores")
+    parser.add_argument("--follow", action="store_true", help="wait for shards bulk_generate.py is still writing")
+    parser.add_argument("--limit", type=int, default=None, help="only clouds 0..limit-1")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    written = reconstruct_all(args.clouds, args.out_dir, args.method, args.resolution, args.k, args.format,
+                              args.workers, args.follow, args.limit)
+    seconds = time.perf_counter() - start
+    print("%d meshes in %.1fs  %.2f meshes/sec" % (written, seconds, written / max(seconds, 1e-9)))
@@ -0,0 +1,67 @@
+import json
+import os
+import numpy as np
+
+# ====== STANDALONE LOADER FOR THE EXPORTED GENERATOR ===========
+# Only needs numpy and a TFLite interpreter (tflite_runtime if installed, otherwise tensorflow).
+# Does not import the training code or build any Keras model.
+
+
+class BluenoModel:
+    def __init__(self, export_dir="exported_generator", variant="generator_quant.tflite"):
+        """variant: "generator.tflite", "generator_quant.tflite" or "saved_model" """
+        with open(os.path.join(export_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.latent_dim = meta["latent_dim"]
+        self.num_points = meta["num_points"]
+        self.batch_sz = None
+
+        path = os.path.join(export_dir, variant)
+        if variant == "saved_model":
+            import tensorflow as tf
+            self.saved_model = tf.saved_model.load(path).signatures["serving_default"]
+            self.interpreter = None
+        else:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+            self.interpreter = Interpreter(model_path=path)
+            self.input_index = self.interpreter.get_input_details()[0]["index"]
+            self.output_index = self.interpreter.get_output_details()[0]["index"]
+
+    def generate_from_latents(self, latent_vecs):
+        """
+        latent_vecs: [B, latent_dim]
+        returns: point clouds [B, N, 3] (float32)
+        """
+        latent_vecs = np.asarray(latent_vecs, dtype=np.float32)
+        if self.interpreter is None:
+            return self.saved_model(latent_vec=latent_vecs)["clouds"].numpy()
+
+        # the batch dimension is dynamic, only reallocate when it changes
+        if len(latent_vecs) != self.batch_sz:
+            self.interpreter.resize_tensor_input(self.input_index, latent_vecs.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_sz = len(latent_vecs)
+        self.interpreter.set_tensor(self.input_index, latent_vecs)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def generate(self, n=1, seed=None):
+        """returns: n clouds [n, N, 3] from N(0,1) latent vectors drawn with the given seed"""
+        latent_vecs = np.random.default_rng(seed).standard_normal([n, self.latent_dim]).astype(np.float32)
+        return self.generate_from_latents(latent_vecs)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="generate point clouds with an exported generator")
+    parser.add_argument("--model", default="exported_generator")
+    parser.add_argument("--variant", default="generator_quant.tflite")
+    parser.add_argument("-n", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default="bluenos.npy")
+    args = parser.parse_args()
+    np.save(args.out, BluenoModel(args.model, args.variant).generate(args.n, args.seed))
@@ -0,0 +1,171 @@
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+# ====== LOCAL GENERATION SERVER ===========
+# POST /generate  {"seed": 7} or {"latent": [...latent_dim floats]}, ?format=raw|npy|xyz|ply (default raw float32 [N,3])
+# GET  /metrics   queue depth, batch fill, timing and failed batches as JSON
+# Concurrent requests are coalesced into one Generator forward pass of up to max_batch clouds.
+
+
+class Request:
+    def __init__(self, latent_vec):
+        self.latent_vec = latent_vec
+        self.done = threading.Event()
+        self.cloud = None
+        self.error = None
+
+
+class Batcher:
+    """
+    collects requests for at most `window` seconds (or until max_batch are waiting) and runs them as one batch
+    forward: function [B, latent_dim] -> [B, N, 3]
+    """
+    def __init__(self, forward, max_batch=16, window=0.005):
+        self.forward = forward
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "batches": 0, "failed_batches": 0, "failed_requests": 0, "forward_seconds": 0.0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, latent_vec):
+        """blocks until the cloud for latent_vec [latent_dim] is ready, returns [N, 3]"""
+        request = Request(latent_vec)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.cloud
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            failed = False
+            try:
+                clouds = self.forward(np.stack([request.latent_vec for request in batch]))
+                for request, cloud in zip(batch, clouds):
+                    request.cloud = cloud
+            except Exception as e:
+                failed = True
+                for request in batch:
+                    request.error = e
+            with self.lock:
+                self.stats["requests"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["failed_batches"] += failed
+                self.stats["failed_requests"] += len(batch) * failed
+                self.stats["forward_seconds"] += time.perf_counter() - start
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        batches = max(stats["batches"], 1)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["mean_batch_size"] = stats["requests"] / batches
+        stats["mean_batch_fill"] = stats["requests"] / (batches * self.max_batch)
+        stats["mean_forward_ms"] = 1000 * stats["forward_seconds"] / batches
+        return stats
+
+
+def encode_cloud(cloud, fmt):
+    """cloud: [N, 3], returns (content type, bytes)"""
+    cloud = np.asarray(cloud, dtype=np.float32)
+    if fmt == "raw":
+        return "application/octet-stream", cloud.tobytes()
+    if fmt == "npy":
+        buf = io.BytesIO()
+        np.save(buf, cloud)
+        return "application/octet-stream", buf.getvalue()
+    if fmt == "xyz":
+        return "text/plain", "".join("%f %f %f\n" % tuple(p) for p in cloud).encode()
+    if fmt == "ply":
+        header = "ply\nformat binary_little_endian 1.0\nelement vertex %d\n" % len(cloud)
+        header += "property float x\nproperty float y\nproperty float z\nend_header\n"
+        return "application/octet-stream", header.encode() + cloud.astype("<f4").tobytes()
+    raise ValueError("unknown format " + fmt)
+
+
+def make_handler(batcher, latent_dim):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, code, content_type, body):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/metrics":
+                return self.send(404, "text/plain", b"not found")
+            self.send(200, "application/json", json.dumps(batcher.metrics()).encode())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/generate":
+                return self.send(404, "text/plain", b"not found")
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if "latent" in body:
+                    latent_vec = np.asarray(body["latent"], dtype=np.float32).reshape([latent_dim])
+                else:
+                    latent_vec = np.random.default_rng(body.get("seed")).standard_normal(latent_dim).astype(np.float32)
+                fmt = parse_qs(url.query).get("format", ["raw"])[0]
+                encode_cloud(np.zeros([1, 3]), fmt) # reject bad formats before queueing
+            except (ValueError, TypeError) as e:
+                return self.send(400, "text/plain", str(e).encode())
+            try:
+                cloud = batcher.submit(latent_vec)
+            except Exception as e: # the forward pass failed, for the whole batch this request was in
+                return self.send(500, "text/plain", ("generation failed: %s" % e).encode())
+            self.send(200, *encode_cloud(cloud, fmt))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve generated Bluenos over HTTP")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=16)
+    parser.add_argument("--window_ms", type=float, default=5)
+    parser.add_argument("--export_dir", default=None, help="serve an exported model (runtime.py) instead of the checkpoint")
+    args = parser.parse_args()
+
+    if args.export_dir:
+        from runtime import BluenoModel
+        model = BluenoModel(args.export_dir, "saved_model")
+        forward, latent_dim = model.generate_from_latents, model.latent_dim
+    else:
+        import tensorflow as tf
+        from inference import load_generator, latent_dim
+        G, sphere = load_generator()
+        sphere = tf.cast(sphere, tf.float32)
+        forward = lambda latent_vecs: G.infer(sphere, latent_vecs).numpy()
+
+    batcher = Batcher(forward, args.max_batch, args.window_ms / 1000)
+    batcher.submit(np.zeros(latent_dim, np.float32)) # warm up (trace) before accepting requests
+    print("serving on port", args.port)
+    ThreadingHTTPServer(("", args.port), make_handler(batcher, latent_dim)).serve_forever()
@@ -0,0 +1,84 @@
+import os
+from functools import lru_cache
+import numpy as np
+import tensorflow as tf
+import trimesh
+import trimesh.exchange.xyz
+from generator import GraphAttention
+
+# ====== SPHERE PRIOR ===========
+# The FIXED sphere the generator deforms, for any number of points:
+#   sphere_<N>_points.xyz         bundled text files (N = 1024, 2048), the points the trained model was trained on
+#   sphere_<N>_points.npy         binary cache loaded memory-mapped, converted from the .xyz once, or for any other N
+#                                 generated as a Fibonacci lattice (evenly spread, deterministic)
+#   sphere_<N>_points_knn<k>.npy  its kNN graph
+
+
+def sphere_path(num_points):
+    return "sphere_" + str(num_points) + "_points.xyz"
+
+
+def sphere_cache_path(num_points):
+    return os.path.splitext(sphere_path(num_points))[0] + ".npy"
+
+
+def fibonacci_sphere(num_points):
+    """
+    N points of the unit sphere at equal area spacing: evenly spaced heights, successive points a golden angle apart
+    returns: [N, 3] (float64)
+    """
+    i = np.arange(num_points) + 0.5
+    z = 1 - 2 * i / num_points
+    radius = np.sqrt(1 - z**2)
+    theta = np.pi * (3 - np.sqrt(5)) * i
+    return np.stack([radius * np.cos(theta), radius * np.sin(theta), z], axis=-1)
+
+
+def sphere_points(num_points):
+    """
+    returns: memory-mapped sphere points [N, 3] (float64), written to the binary cache on the first call
+    """
+    xyz_path, cache_path = sphere_path(num_points), sphere_cache_path(num_points)
+    bundled = os.path.exists(xyz_path)
+    if not os.path.exists(cache_path) or (bundled and os.path.getmtime(cache_path) < os.path.getmtime(xyz_path)):
+        if bundled:
+            with open(xyz_path) as file:
+                points = trimesh.exchange.xyz.load_xyz(file)['vertices'] #verts only
+        else:
+            points = fibonacci_sphere(num_points)
+        tmp_path = cache_path + ".tmp.npy"
+        np.save(tmp_path, np.reshape(points, [num_points, 3]).astype(np.float64))
+        os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode="r")
+
+
+def load_sphere(num_points):
+    """
+    reads in the FIXED sphere points
+    returns: [N, 3]
+    """
+    return tf.constant(sphere_points(num_points)) #[N,3]
+
+
+@lru_cache(maxsize=None)
+def sphere_knn(num_points, k=20):
+    """
+    kNN graph of the FIXED sphere. The sphere never changes so its neighborhood only has to be found once:
+    the indices are cached in memory and on disk next to the sphere points (rebuilt if the points are newer).
+
+    returns: neighbor indices [N, k] (int32), identical to GraphAttention.knn on the sphere
+    """
+    points_path = sphere_cache_path(num_points)
+    sphere = sphere_points(num_points)
+    cache_path = os.path.splitext(points_path)[0] + "_knn" + str(k) + ".npy"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(points_path):
+        return np.load(cache_path, mmap_mode="r")
+
+    # same ops (and float32 precision) as GraphAttention so ties break the same way
+    sphere = tf.cast(sphere, tf.float32)
+    nn_idx = GraphAttention.knn_tiled(tf.expand_dims(sphere, 0), k=k)[0].numpy() # [N, k]
+    # workers started together may build it at once: never let one read a half-written file
+    tmp_path = cache_path + ".tmp%d.npy" % os.getpid()
+    np.save(tmp_path, nn_idx)
+    os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode="r")
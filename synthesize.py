@@ -0,0 +1,198 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import numpy as np
+import trimesh
+from preprocess import (cache_dir, mesh_paths, point_cloud_cache_path, sample_surface, save_triangle_tables, triangle_table,
+                        triangle_tables_prefix, write_cache_metadata)
+
+# ====== DATASET SYNTHESIS ===========
+# Builds blueno<i>.stl with OpenSCAD (headless, any OS) across a worker pool, replacing 960generator.bat.
+# Every shape gets its own parameter vector drawn from (seed, i) and passed with -D, so the dataset can be rebuilt
+# or extended exactly. <out_dir>/manifest.jsonl records the parameters of every built shape; shapes whose STL exists
+# with the same parameters are skipped. Finished meshes are parsed right away (in a process pool, while OpenSCAD
+# keeps running) into both caches main.py reads: the sampled clouds (load_point_clouds) and the triangle tables
+# (load_triangle_tables, for resample_every_epoch). The tables are assembled from per-mesh files once the build is done.
+#   python synthesize.py --num_shapes 20000 --workers 16
+
+# bounds of every -D parameter of blueno.scad, the same as its rands() defaults
+parameter_bounds = {
+    "headSize": (1.2, 1.8),
+    "earThickness": (0.4, 0.6),
+    "noseThickness": (0.5, 1.1),
+    "lampSize": (0.5, 0.9),
+    "armLength": (0.5, 0.8),
+    "armRadius": (0.1, 0.2),
+    "armYDeg": (100, 120),
+    "armZDeg": (40, 70),
+    "legLength": (0.5, 0.8),
+    "legRadius": (0.1, 0.2),
+    "legYDeg": (90, 110),
+    "legZDeg": (15, 25),
+}
+
+
+def shape_parameters(seed, i):
+    """returns: {name: value} of shape i, the same for a given (seed, i) whatever else gets built"""
+    rng = np.random.default_rng([seed, i])
+    return {name: float(rng.uniform(low, high)) for name, (low, high) in parameter_bounds.items()}
+
+
+def build_shape(openscad, scad_path, out_path, params):
+    """runs OpenSCAD on one parameter vector, returns seconds taken"""
+    start = time.perf_counter()
+    tmp_path = out_path[:-len(".stl")] + ".tmp.stl" # OpenSCAD picks the format from the extension
+    defines = [arg for name, value in params.items() for arg in ("-D", "%s=%r" % (name, value))]
+    result = subprocess.run([openscad, "-o", tmp_path] + defines + [scad_path], capture_output=True, text=True)
+    if result.returncode != 0 or not os.path.exists(tmp_path):
+        raise RuntimeError("openscad failed on %s:\n%s" % (out_path, result.stderr))
+    os.replace(tmp_path, out_path) # a killed run never leaves a truncated STL behind
+    return time.perf_counter() - start
+
+
+def prepare_mesh(args):
+    """worker: parses one mesh, saves its triangle table to triangles_path (if any), returns its cloud (or None)"""
+    path, num_points, seed, i, sample, triangles_path = args
+    triangles = triangle_table(trimesh.load(path))
+    if triangles_path:
+        np.save(triangles_path, triangles)
+    if sample:
+        return sample_surface(triangles, num_points, np.random.default_rng([seed, i])) # as preprocess.sample_mesh
+
+
+def read_manifest(path):
+    """returns: {index: last manifest entry of that shape}"""
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["index"]] = entry
+    return entries
+
+
+def synthesize(num_shapes, seed=0, out_dir="./blueno", scad_path="./blueno/blueno.scad", openscad="openscad",
+               workers=None, sample_workers=None, num_points=2048, sample=True, triangles=True):
+    """
+    builds the missing shapes 0..num_shapes-1 and, with sample / triangles, the point cloud cache / triangle tables
+    of all of them
+    returns: the memory-mapped clouds [num_shapes, num_points, 3] or None
+    """
+    if shutil.which(openscad) is None and not os.path.exists(openscad):
+        raise FileNotFoundError("openscad not found: " + openscad)
+    workers = workers or os.cpu_count()
+    os.makedirs(out_dir, exist_ok=True)
+    paths = mesh_paths(num_shapes, out_dir)
+    manifest_path = os.path.join(out_dir, "manifest.jsonl")
+    manifest = read_manifest(manifest_path)
+    todo = []
+    for i, path in enumerate(paths):
+        params = shape_parameters(seed, i)
+        entry = manifest.get(i)
+        if not (os.path.exists(path) and entry and entry["seed"] == seed and entry["params"] == params):
+            todo.append((i, params))
+    print("building %d of %d shapes (%d done)" % (len(todo), num_shapes, num_shapes - len(todo)))
+
+    # every mesh is final once the cache key is known, so an unchanged set of shapes keeps its caches
+    if sample and not todo and os.path.exists(point_cloud_cache_path(paths, num_points, seed)):
+        sample = False
+    if triangles and not todo and os.path.exists(triangle_tables_prefix(paths) + "_offsets.npy"):
+        triangles = False
+    os.makedirs(cache_dir, exist_ok=True)
+    clouds = None
+    if sample:
+        tmp_path = os.path.join(cache_dir, "synthesize_%d_%d.tmp.npy" % (num_points, seed))
+        clouds = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(num_shapes, num_points, 3))
+    tables_dir = os.path.join(cache_dir, "synthesize_triangles.tmp")
+    if triangles:
+        os.makedirs(tables_dir, exist_ok=True)
+
+    def parse(i):
+        table_path = os.path.join(tables_dir, "%d.npy" % i) if triangles else None
+        return samplers.submit(prepare_mesh, (paths[i], num_points, seed, i, sample, table_path))
+
+    start = time.perf_counter()
+    failed = []
+    # samplers must not be forked from this process while builder threads have OpenSCAD pipes open
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["preprocess"])
+    with ThreadPoolExecutor(workers) as builders, ProcessPoolExecutor(sample_workers, context) as samplers, \
+            open(manifest_path, "a") as manifest_file:
+        building = {builders.submit(build_shape, openscad, scad_path, paths[i], params): (i, params) for i, params in todo}
+        sampling = {}
+        if sample or triangles:
+            # already built shapes are parsed while the new ones build
+            for i in sorted(set(range(num_shapes)) - set(i for i, _ in todo)):
+                sampling[parse(i)] = i
+        built = 0
+        while building or sampling:
+            done, _ = wait(list(building) + list(sampling), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in building:
+                    i, params = building.pop(future)
+                    try:
+                        seconds = future.result()
+                    except RuntimeError as error:
+                        print(error)
+                        failed.append(i)
+                        continue
+                    manifest_file.write(json.dumps({"index": i, "seed": seed, "params": params, "file": os.path.basename(paths[i]),
+                        "seconds": round(seconds, 3)}) + "\n")
+                    manifest_file.flush()
+                    built += 1
+                    if built % 100 == 0 or built == len(todo):
+                        elapsed = time.perf_counter() - start
+                        print("%d/%d built  %.1f shapes/sec" % (built, len(todo), built / elapsed))
+                    if sample or triangles:
+                        sampling[parse(i)] = i
+                else:
+                    i = sampling.pop(future)
+                    if sample:
+                        clouds[i] = future.result()
+                    else:
+                        future.result()
+
+    if failed:
+        raise RuntimeError("%d shapes failed (e.g. %s), rerun to retry them" % (len(failed), paths[failed[0]]))
+    if sample:
+        clouds.flush()
+        del clouds
+        # the same file load_point_clouds(mesh_paths(num_shapes, out_dir), num_points, seed) would have built
+        out_path = point_cloud_cache_path(paths, num_points, seed)
+        os.replace(tmp_path, out_path)
+        write_cache_metadata(out_path, paths, num_points, seed)
+        print("cached clouds in", out_path)
+    if triangles:
+        # the same files load_triangle_tables(mesh_paths(num_shapes, out_dir)) would have built
+        prefix = triangle_tables_prefix(paths)
+        save_triangle_tables(prefix, [np.load(os.path.join(tables_dir, "%d.npy" % i), mmap_mode="r") for i in range(num_shapes)])
+        shutil.rmtree(tables_dir)
+        print("cached triangle tables in", prefix + "_*.npy")
+    if os.path.exists(point_cloud_cache_path(paths, num_points, seed)):
+        return np.load(point_cloud_cache_path(paths, num_points, seed), mmap_mode="r")
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the Blueno dataset with OpenSCAD and sample it")
+    parser.add_argument("--num_shapes", type=int, default=960)
+    parser.add_argument("--seed", type=int, default=0, help="seeds both the shape parameters and the point sampling")
+    parser.add_argument("--out_dir", default="./blueno")
+    parser.add_argument("--scad", default="./blueno/blueno.scad")
+    parser.add_argument("--openscad", default="openscad", help="OpenSCAD executable")
+    parser.add_argument("--workers", type=int, default=None, help="concurrent OpenSCAD processes, default cores")
+    parser.add_argument("--sample_workers", type=int, default=None, help="point sampling processes, default cores")
+    parser.add_argument("--num_points", type=int, default=2048)
+    parser.add_argument("--no_sample", action="store_true", help="skip the point cloud cache")
+    parser.add_argument("--no_triangles", action="store_true", help="skip the triangle tables (resample_every_epoch)")
+    args = parser.parse_args()
+    clouds = synthesize(args.num_shapes, args.seed, args.out_dir, args.scad, args.openscad, args.workers,
+                        args.sample_workers, args.num_points, not args.no_sample, not args.no_triangles)
+    if clouds is not None:
+        print("cached clouds:", clouds.shape)
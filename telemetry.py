@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+# ====== TRAINING TELEMETRY ===========
+# The training loop only adds loss tensors together (on device) and hands them to a queue; a background thread
+# pulls them to the host and appends them to <log_dir>/metrics.jsonl and a TensorBoard event file.
+# Live plotting is a separate process:  python telemetry.py plot training_logs/metrics.jsonl
+
+
+class MetricsLogger:
+    def __init__(self, log_dir="training_logs", tensorboard=True):
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, "metrics.jsonl")
+        self.tensorboard = tensorboard
+        self.log_dir = log_dir
+        self.sums = {}
+        self.count = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def accumulate(self, **metrics):
+        """adds this step's metric tensors to the running sums without reading them back"""
+        for name, value in metrics.items():
+            self.sums[name] = value if name not in self.sums else self.sums[name] + value
+        self.count += 1
+
+    def log_accumulated(self, step, **extra):
+        """queues the means since the last call (plus any host-side values such as timings)"""
+        if self.count:
+            means = {name: total / self.count for name, total in self.sums.items()}
+            self.sums, self.count = {}, 0
+            self.log(step, **means, **extra)
+
+    def log(self, step, **metrics):
+        self.queue.put((step, time.time(), metrics))
+
+    def run(self):
+        writer = None
+        if self.tensorboard:
+            import tensorflow as tf
+            writer = tf.summary.create_file_writer(self.log_dir)
+        with open(self.path, "a") as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                step, wall_time, metrics = item
+                values = {name: float(value) for name, value in metrics.items()} # blocks this thread only
+                f.write(json.dumps(dict(step=step, time=wall_time, **values)) + "\n")
+                if self.queue.empty():
+                    f.flush()
+                if writer is not None:
+                    with writer.as_default(step=step):
+                        for name, value in values.items():
+                            tf.summary.scalar(name, value)
+        if writer is not None:
+            writer.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def read_metrics(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def plot(path, interval=2.0):
+    """live viewer: redraws the D/G loss curves from metrics.jsonl every `interval` seconds"""
+    from matplotlib import pyplot
+    while True:
+        records = read_metrics(path) if os.path.exists(path) else []
+        pyplot.cla()
+        for name in ["g_loss", "d_loss"]:
+            points = [(r["step"], r[name]) for r in records if name in r]
+            if points:
+                pyplot.plot(*zip(*points), label=name)
+        pyplot.xlabel("batch")
+        pyplot.ylabel("loss")
+        if records:
+            pyplot.legend()
+        pyplot.title("G vs. D losses")
+        pyplot.pause(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="training telemetry tools")
+    parser.add_argument("command", choices=["plot"])
+    parser.add_argument("path", nargs="?", default="training_logs/metrics.jsonl")
+    args = parser.parse_args()
+    plot(args.path)